@@ -1,28 +1,108 @@
 #!/usr/bin/env python
 
+import time
+
+START_TIME = time.perf_counter()
+
+import argparse
+import getpass
 import sys
+from itertools import zip_longest
 
+import numpy as np
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtWidgets import (QPushButton, QHBoxLayout, QVBoxLayout, QLabel,
                              QCheckBox, QComboBox, QApplication, QWidget,
-                             QFrame)
-import nibabel as nib
-from skimage.measure import marching_cubes
+                             QFrame, QProgressBar, QFileDialog, QTabWidget)
+from src.columnar import ERROR_REASONS
 from src.dataloader import DataLoader
 from src.filedialog import SelectPathsDialog
-from src.segviewer import SegmentationViewer
+from src.segviewer import SegmentationViewer, SliceViewer
 from src.likert import LikertScale
+from src.prefetch import ImagePrefetcher
+from src.meshing import DEFAULT_CACHE_DIR, MeshWorker
+from src.meshview import MeshViewer
+from src.shared_store import SharedReviewStore
+from src.telemetry import Telemetry
+from src.qc import DEFAULT_RULES, QCRules
+from src.review_queue import PRIORITIES
+from src.sampledialog import SampleDialog
+from src.sampling import load_manifest
+
+# Journalled changes before the summary csv is rewritten in the background.
+COMPACT_EVERY = 500
+
+# Longest single visit counted as dwell time; longer ones are most likely
+# a reviewer away from the screen.
+MAX_DWELL_S = 600
+
+# Site filter entry that keeps every site.
+ALL_SITES = "All sites"
+
+# Geometry metrics offered for ordering the review, with their sort direction.
+SORT_METRICS = {
+    "geo_components": False,
+    "geo_largest_fraction": True,
+    "geo_voxels": False,
+    "geo_extent_z": True,
+}
 
 
 class MainWindow(QWidget):
 
-    def __init__(self):
+    def __init__(self,
+                 prefetch_depth: int = 3,
+                 prefetch_mb: int = 512,
+                 mesh_step: int = 1,
+                 mesh_downsample: int = 1,
+                 mesh_cache=DEFAULT_CACHE_DIR,
+                 mesh_coarse: int = 4,
+                 mesh_budget: int = 200000,
+                 mesh_refine: bool = True,
+                 columnar: bool = False,
+                 shared_store: str = None,
+                 store_journal_mode: str = "WAL",
+                 reviewer: str = None,
+                 qc_rules=DEFAULT_RULES,
+                 trace_path: str = None):
         super(MainWindow, self).__init__()
 
         self.idx = -1
         self.pid = 0
+        self.history = []
+        self.load_start = None
+        self.mesh_step = mesh_step
+        self.mesh_downsample = mesh_downsample
+        self.mesh_cache = mesh_cache
+        self.mesh_coarse = mesh_coarse
+        self.mesh_budget = mesh_budget
+        self.mesh_refine = mesh_refine
+        self.mesh_worker = None
+        self.pending_mesh = None
+        self.columnar = columnar
+        self.shared_store = shared_store
+        self.store_journal_mode = store_journal_mode
+        self.reviewer = reviewer or getpass.getuser()
+        self.qc_rules = QCRules.from_file(qc_rules)
+        self.telemetry = Telemetry(trace_path=trace_path)
+        self.case_shown = None
+        self.loading_values = False
+        # Keeps shared store claims alive while a case is open for long.
+        self.lease_timer = QtCore.QTimer(self)
+        self.lease_timer.timeout.connect(self.renew_claims)
 
         self.viewer = SegmentationViewer(self)
+        self.slice_viewer = SliceViewer(self)
+        self.view_tabs = QTabWidget(self)
+        self.view_tabs.addTab(self.viewer, "Projections")
+        self.view_tabs.addTab(self.slice_viewer, "Slices")
+        self.mesh_view = MeshViewer(self)
+        self.view_tabs.addTab(self.mesh_view, "3D")
+        self.view_tabs.currentChanged.connect(self.view_tab_changed)
+        self.prefetcher = ImagePrefetcher(self,
+                                          depth=prefetch_depth,
+                                          max_bytes=prefetch_mb * 1024 * 1024,
+                                          telemetry=self.telemetry)
         self.setFocusPolicy(QtCore.Qt.StrongFocus)
 
         files_dialog = SelectPathsDialog(self)
@@ -45,6 +125,11 @@ class MainWindow(QWidget):
         button_layout.addWidget(next_button)
         button_layout.addWidget(seg_button)
 
+        self.mesh_progress = QProgressBar(self)
+        self.mesh_progress.setFormat("Mesh: %p%")
+        self.mesh_progress.hide()
+        button_layout.addWidget(self.mesh_progress)
+
         # Create labels
         font = QtGui.QFont()
         font.setPointSize(26)
@@ -61,6 +146,51 @@ class MainWindow(QWidget):
         label_layout.addWidget(self.tav_label)
         label_layout.addWidget(self.tac_label)
 
+        self.metrics_label = QLabel("", self)
+        metrics_font = QtGui.QFont()
+        metrics_font.setPointSize(14)
+        self.metrics_label.setFont(metrics_font)
+
+        self.sort_combobox = QComboBox(self)
+        self.sort_combobox.addItem("Default order")
+        for metric in SORT_METRICS:
+            self.sort_combobox.addItem(metric)
+        self.sort_combobox.currentTextChanged.connect(self.sort_changed)
+        metrics_layout = QHBoxLayout()
+        metrics_layout.addWidget(self.metrics_label)
+        self.stats_label = QLabel("", self)
+        self.stats_label.hide()
+        metrics_layout.addWidget(self.stats_label)
+        metrics_layout.addStretch()
+        metrics_layout.addWidget(QLabel("Sort by:", self))
+        metrics_layout.addWidget(self.sort_combobox)
+
+        self.priority_combobox = QComboBox(self)
+        self.priority_combobox.addItems(PRIORITIES)
+        self.priority_combobox.currentTextChanged.connect(
+            self.priority_changed)
+        self.filter_combobox = QComboBox(self)
+        self.filter_combobox.addItem("All reasons")
+        self.filter_combobox.addItems(ERROR_REASONS)
+        self.filter_combobox.currentTextChanged.connect(self.filter_changed)
+        self.site_combobox = QComboBox(self)
+        self.site_combobox.addItem(ALL_SITES)
+        self.site_combobox.currentTextChanged.connect(self.filter_changed)
+        # Shown once a summary with a site column is loaded.
+        self.site_combobox.hide()
+        metrics_layout.addWidget(QLabel("Queue:", self))
+        metrics_layout.addWidget(self.priority_combobox)
+        metrics_layout.addWidget(self.filter_combobox)
+        metrics_layout.addWidget(self.site_combobox)
+
+        self.samples = {}
+        sample_button = QPushButton("Sample...", self)
+        sample_button.clicked.connect(self.sample_clicked)
+        open_sample_button = QPushButton("Open Sample", self)
+        open_sample_button.clicked.connect(self.open_sample_clicked)
+        metrics_layout.addWidget(sample_button)
+        metrics_layout.addWidget(open_sample_button)
+
         # Create checkboxes
         self.error_checkbox = QCheckBox("Error", self)
         self.reviewed_checkbox = QCheckBox("Reviewed", self)
@@ -79,11 +209,9 @@ class MainWindow(QWidget):
 
         # Create the combobox and add options
         self.reason_combobox = QComboBox(self)
-        self.reason_combobox.addItem("Discontinuous")
-        self.reason_combobox.addItem("Leak")
-        self.reason_combobox.addItem("Expiratory")
-        self.reason_combobox.addItem("Other")
+        self.reason_combobox.addItems(ERROR_REASONS)
         self.reason_combobox.setFont(font)
+        self.reason_combobox.currentTextChanged.connect(self.reason_changed)
 
         self.scale_leaks = LikertScale(
             self, "Detected Leaks",
@@ -94,6 +222,13 @@ class MainWindow(QWidget):
         self.scale_subseg = LikertScale(
             self, "Segmentation Extent",
             ["Complete", "Almost Complete", "Partial", "Incomplete"])
+        # Every score is journalled as soon as it is picked.
+        self.scale_leaks.scoreChanged.connect(
+            lambda score: self.score_changed("bp_leak_score", score))
+        self.scale_segmental.scoreChanged.connect(
+            lambda score: self.score_changed("bp_segmental_score", score))
+        self.scale_subseg.scoreChanged.connect(
+            lambda score: self.score_changed("bp_subsegmental_score", score))
 
         likert_layout = QHBoxLayout()
         likert_layout.addWidget(self.scale_leaks)
@@ -124,29 +259,86 @@ class MainWindow(QWidget):
 
         # Arrange layout
         vblayout = QVBoxLayout(self)
-        vblayout.addWidget(self.viewer)
+        vblayout.addWidget(self.view_tabs)
         vblayout.addLayout(button_layout)
         vblayout.addLayout(label_layout)
+        vblayout.addLayout(metrics_layout)
         vblayout.addLayout(checkbox_layout)
         vblayout.addLayout(likert_layout)
 
         self.showMaximized()
 
-    def load_case(self, increment: bool):
+    def load_case(self, increment: bool, flagged: bool = False):
+        if self.revdata.flagged_df.empty:
+            if self.revdata.store is not None:
+                self.revdata.claim_cases()
+            if self.revdata.flagged_df.empty:
+                print("Nothing to review")
+                self.metrics_label.setText("Nothing to review")
+                return
 
         def _load_image():
-            pid = str(self.pid)
-            if any(pid in s for s in self.revdata.image_list):
-                matching = [s for s in self.revdata.image_list if pid in s]
-                image_path = matching[0]
-                self.viewer.setPhoto(QtGui.QPixmap(image_path))
+            image_path = self.revdata.image_for(self.pid)
+            preview_path = self.revdata.preview_for(self.pid)
+            if image_path is not None and preview_path is not None:
+                # The small preview shows first; the full image is decoded in
+                # the background and swapped in on zoom.
+                self.viewer.setPhoto(
+                    self.prefetcher.get(preview_path),
+                    full_size=QtGui.QImageReader(image_path).size(),
+                    load_full=lambda: self.prefetcher.get(image_path))
+                self.prefetcher.prefetch([image_path])
+            elif image_path is not None:
+                self.viewer.setPhoto(self.prefetcher.get(image_path))
             else:
-                print(f"{pid} segmentation image not found")
+                print(f"{self.pid} segmentation image not found")
+            if self.load_start is not None:
+                print(f"First image shown {time.perf_counter() - self.load_start:.2f}s "
+                      f"after loading data, "
+                      f"{time.perf_counter() - START_TIME:.2f}s after start")
+                self.load_start = None
+            self.prefetcher.prefetch(_neighbour_images())
+            if self.view_tabs.currentWidget() is self.slice_viewer:
+                self.load_slices()
+            if self.view_tabs.currentWidget() is self.mesh_view:
+                self.request_mesh()
+            else:
+                self.mesh_view.clear()
+
+        def _neighbour_images():
+            # The cases Next and Prev would show: the head of the review queue
+            # and the history, nearest first and alternating. A walk of the
+            # queue stands in once either runs out, as it does in _get_pid.
+            pids = self.revdata.flagged_df.participant_id
+            depth = self.prefetcher.depth
+            queue = self.revdata.active_queue()
+
+            def _walk(step):
+                rows, row = [], self.idx
+                for _ in range(depth):
+                    row = queue.walk(row, step)
+                    if row is None or row == self.idx or row in rows:
+                        break
+                    rows.append(row)
+                return rows
+
+            ahead = queue.peek(depth, exclude=self.idx) or _walk(1)
+            behind = self.history[:-depth - 1:-1] or _walk(-1)
+            paths = []
+            for rows in zip_longest(ahead, behind):
+                for row in rows:
+                    if row is None:
+                        continue
+                    pid = pids.iat[row]
+                    paths.append(
+                        self.revdata.preview_for(pid, wait=False)
+                        or self.revdata.image_for(pid, wait=False))
+            return paths
 
         def _load_values():
 
-            def _get_color(value, min_range, max_range):
-                if value < min_range or value > max_range:
+            def _get_color(column, value):
+                if self.qc_rules.fails(column, value):
                     return "red"
                 else:
                     return "black"
@@ -158,9 +350,9 @@ class MainWindow(QWidget):
             err = self.revdata.flagged_df.at[self.idx, 'bp_seg_error']
             rev = self.revdata.flagged_df.at[self.idx, 'bp_reviewed']
 
-            tlv_col = _get_color(tlv, 3.5, 8.0)
-            tav_col = _get_color(tav, 0.08, 0.4)
-            tac_col = _get_color(tac, 150, 400)
+            tlv_col = _get_color('bp_tlv', tlv)
+            tav_col = _get_color('bp_airvol', tav)
+            tac_col = _get_color('bp_tcount', tac)
 
             self.tlv_label.setText(f"TLV: {tlv}")
             self.tav_label.setText(f"TAV: {tav}")
@@ -180,6 +372,17 @@ class MainWindow(QWidget):
             else:
                 self.reviewed_checkbox.setChecked(False)
 
+            metrics = self.revdata.metrics_for(self.pid)
+            if metrics is not None:
+                self.metrics_label.setText(
+                    f"Components: {metrics.geo_components}  "
+                    f"Largest: {metrics.geo_largest_fraction:.1%}  "
+                    f"Voxels: {metrics.geo_voxels}  "
+                    f"Extent: {metrics.geo_extent_x}x{metrics.geo_extent_y}"
+                    f"x{metrics.geo_extent_z}")
+            else:
+                self.metrics_label.setText("")
+
             self.scale_leaks.highest_button.setChecked(True)
             self.scale_segmental.highest_button.setChecked(True)
             self.scale_subseg.highest_button.setChecked(True)
@@ -188,43 +391,96 @@ class MainWindow(QWidget):
             if self.idx == -1:
                 print("Starting Review")
                 return
+            self.record_dwell()
 
             if self.error_checkbox.isChecked():
-                self.revdata.flagged_df.at[
-                    self.idx,
-                    'bp_err_reason'] = self.reason_combobox.currentText()
+                self.revdata.set_value(self.idx, 'bp_err_reason',
+                                       self.reason_combobox.currentText())
 
             if not self.reviewed_checkbox.isChecked():
                 self.reviewed_checkbox.setChecked(True)
 
-            self.revdata.flagged_df.at[
-                self.idx, 'bp_leak_score'] = self.scale_leaks.score
-            self.revdata.flagged_df.at[
-                self.idx, 'bp_segmental_score'] = self.scale_segmental.score
-            self.revdata.flagged_df.at[
-                self.idx, 'bp_subsegmental_score'] = self.scale_subseg.score
+            self.revdata.set_value(self.idx, 'bp_leak_score',
+                                   self.scale_leaks.score)
+            self.revdata.set_value(self.idx, 'bp_segmental_score',
+                                   self.scale_segmental.score)
+            self.revdata.set_value(self.idx, 'bp_subsegmental_score',
+                                   self.scale_subseg.score)
+            if self.revdata.store is not None:
+                self.revdata.commit_case(self.idx)
+
+        def _next_in_queue():
+            queue = self.revdata.active_queue()
+            if flagged:
+                return queue.next_flagged(exclude=self.idx)
+            return queue.next(exclude=self.idx)
 
         def _get_pid(increment):
-            if increment:
-                self.idx += 1
+            target = _next_in_queue() if increment else None
+            if (increment and target is None
+                    and self.revdata.store is not None
+                    and self.revdata.claim_cases() > 0):
+                target = _next_in_queue()
+
+            if target is not None:
+                if self.idx != -1:
+                    self.history.append(self.idx)
+                self.idx = target
+            elif not increment and self.history:
+                self.idx = self.history.pop()
             else:
-                self.idx -= 1
-            if self.idx >= self.revdata.flagged_df.shape[0]:
-                self.idx = 0
-            elif self.idx < 0:
-                self.idx = self.revdata.flagged_df.shape[0] - 1
-
+                # Nothing left to review: walk the active queue in list
+                # order, reviewed cases included.
+                step = 1 if increment else -1
+                row = self.revdata.active_queue().walk(self.idx, step)
+                if row is None:
+                    print("No cases in this queue")
+                    if self.idx == -1:
+                        row = self.revdata.queue.walk(self.idx, step)
+                    else:
+                        row = self.idx
+                self.idx = row
+
+            if self.revdata.journal.records >= COMPACT_EVERY:
+                self.revdata.save_flagged_df(background=True)
+                print(f"Saving review csv. List id {self.idx}")
             if self.idx % 10 == 0:
-                self.revdata.save_flagged_df()
-                print(f"Saved review csv. List id {self.idx}")
+                print(self.prefetcher.stats())
+                print(self.telemetry.report())
 
             pt_id = self.revdata.flagged_df.at[self.idx, "participant_id"]
             return pt_id
 
-        _set_values()
-        self.pid = _get_pid(increment)
-        _load_image()
-        _load_values()
+        with self.telemetry.timer("load_case"):
+            with self.telemetry.timer("set_values"):
+                _set_values()
+            with self.telemetry.timer("get_pid"):
+                self.pid = _get_pid(increment)
+            with self.telemetry.timer("load_image"):
+                _load_image()
+            with self.telemetry.timer("load_values"):
+                # Resetting the widgets for the new case is not a review change.
+                self.loading_values = True
+                try:
+                    _load_values()
+                finally:
+                    self.loading_values = False
+        self.case_shown = time.perf_counter()
+        if self.stats_label.isVisible():
+            self.stats_label.setText(self.telemetry.report())
+
+    def record_dwell(self):
+        """
+        Adds the time spent on the current case to its bp_dwell_s.
+        """
+        if self.case_shown is None or self.idx == -1:
+            return
+        dwell = min(time.perf_counter() - self.case_shown, MAX_DWELL_S)
+        self.case_shown = None
+        total = self.revdata.flagged_df.at[self.idx, "bp_dwell_s"]
+        self.revdata.set_value(self.idx, "bp_dwell_s",
+                               round(float(total) + dwell, 1))
+        self.telemetry.case_done()
 
     def prev_button_clicked(self):
         self.load_case(False)
@@ -232,39 +488,263 @@ class MainWindow(QWidget):
     def next_button_clicked(self):
         self.load_case(True)
 
+    def next_flagged_clicked(self):
+        self.load_case(True, flagged=True)
+
     def seg_button_clicked(self):
-        if 'mlab' not in sys.modules:
-            from mayavi import mlab
-        matching = [s for s in self.revdata.seg_list if str(self.pid) in s]
-        seg_arr = nib.load(f"{matching[0]}").get_fdata()
-        verts, faces, norms, vals = marching_cubes(seg_arr, 0)
-        mlab.triangular_mesh(verts[:, 0], verts[:, 1], verts[:, 2], faces)
-        mlab.show()
+        self.view_tabs.setCurrentWidget(self.mesh_view)
+        self.request_mesh()
+
+    def view_tab_changed(self, index):
+        if self.view_tabs.widget(index) is self.slice_viewer:
+            self.load_slices()
+        elif self.view_tabs.widget(index) is self.mesh_view:
+            self.request_mesh()
+
+    def load_slices(self):
+        if not hasattr(self, "revdata") or self.idx == -1:
+            return
+        seg_path = self.revdata.seg_for(self.pid)
+        if seg_path is None:
+            print(f"{self.pid} segmentation not found")
+            return
+        self.slice_viewer.setVolume(seg_path)
+
+    def sort_changed(self, metric):
+        if not hasattr(self, "revdata"):
+            return
+        if metric in SORT_METRICS:
+            if self.revdata.metrics is None:
+                print("No geometry metrics loaded")
+                return
+            self.revdata.sort_flagged_df(metric, SORT_METRICS[metric])
+        else:
+            self.revdata.sort_flagged_df()
+        self.reselect_case()
+
+    def reselect_case(self):
+        """
+        Finds the current case again after flagged_df was reordered.
+        """
+        self.history = []
+        if self.idx != -1:
+            # Keep the current case selected so its scores land on its row.
+            pids = self.revdata.flagged_df.participant_id
+            self.idx = int(pids.index[pids == self.pid][0])
+
+    def renew_claims(self):
+        if not hasattr(self, "revdata") or self.revdata.store is None:
+            return
+        dropped = self.revdata.renew_claims(
+            self.pid if self.idx != -1 else None)
+        if dropped:
+            print(f"{dropped} expired claims were taken by other reviewers")
+            self.reselect_case()
+
+    def priority_changed(self, name):
+        if hasattr(self, "revdata"):
+            self.revdata.set_priority(name)
+
+    def filter_changed(self, _=None):
+        """
+        Restricts the review queue to the chosen reason or sample and site.
+        """
+        if not hasattr(self, "revdata"):
+            return
+        reason = self.filter_combobox.currentText()
+        site = self.site_combobox.currentText()
+        filters = []
+        # Samples drawn with reviewed cases keep them reachable; the rest
+        # only visit their unreviewed cases.
+        reviewed = True
+        if reason in ERROR_REASONS:
+            filters.append(lambda df: df.bp_err_reason == reason)
+        elif reason in self.samples:
+            pids, exclude_reviewed = self.samples[reason]
+            filters.append(self.revdata.sample_filter(pids))
+            reviewed = not exclude_reviewed
+        if site != ALL_SITES:
+            filters.append(self.revdata.site_filter(site))
+        if not filters:
+            self.revdata.set_queue_filter(None)
+            return
+        self.revdata.set_queue_filter(
+            lambda df: np.logical_and.reduce(
+                [np.asarray(f(df), dtype=bool) for f in filters]), reviewed)
+
+    def update_sites(self):
+        """
+        Offers the sites of the loaded summary, keeping the chosen one.
+        """
+        site = self.site_combobox.currentText()
+        sites = self.revdata.sites()
+        self.site_combobox.blockSignals(True)
+        self.site_combobox.clear()
+        self.site_combobox.addItem(ALL_SITES)
+        self.site_combobox.addItems(sites)
+        self.site_combobox.setCurrentText(site if site in sites else ALL_SITES)
+        self.site_combobox.blockSignals(False)
+        self.site_combobox.setVisible(bool(sites))
+
+    def sample_clicked(self):
+        if not hasattr(self, "revdata"):
+            return
+        dialog = SampleDialog(self, list(self.revdata.flagged_df.columns))
+        if dialog.exec_():
+            self.add_sample(dialog.sample(self.revdata))
+
+    def open_sample_clicked(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Open Sample", "",
+                                              "Sample Manifests (*.json)")
+        if path and hasattr(self, "revdata"):
+            manifest = load_manifest(path)
+            self.add_sample((f"Sample: {manifest['name']}",
+                             manifest["participant_ids"],
+                             manifest.get("exclude_reviewed", True)))
+
+    def add_sample(self, sample):
+        """
+        :param sample: (name, participant IDs, exclude_reviewed) tuple.
+        """
+        if sample is None:
+            return
+        name, pids, exclude_reviewed = sample
+        if name not in self.samples:
+            self.filter_combobox.addItem(name)
+        self.samples[name] = (pids, exclude_reviewed)
+        if self.filter_combobox.currentText() == name:
+            self.filter_changed(name)
+        else:
+            self.filter_combobox.setCurrentText(name)
+
+    def request_mesh(self):
+        if not hasattr(self, "revdata") or self.idx == -1:
+            return
+        pid = str(self.pid)
+        if self.mesh_view.pid == pid:
+            return
+        if self.mesh_worker is not None and self.mesh_worker.isRunning():
+            if self.mesh_worker.pid == pid:
+                return
+            # Meshes of cases already left are still cached when they finish.
+            self.pending_mesh = pid
+            self.mesh_view.clear(f"Waiting to build mesh for {pid}")
+            return
+        seg_path = self.revdata.seg_for(pid)
+        if seg_path is None:
+            self.mesh_view.clear(f"{pid} segmentation not found")
+            return
+        self.mesh_view.clear(f"Building mesh for {pid}")
+        self.mesh_worker = MeshWorker(self, pid, seg_path, self.mesh_step,
+                                      self.mesh_downsample, self.mesh_cache,
+                                      self.mesh_coarse, self.mesh_budget,
+                                      self.mesh_refine, self.telemetry)
+        self.mesh_worker.progress.connect(self.mesh_progressed)
+        self.mesh_worker.meshReady.connect(self.show_mesh)
+        self.mesh_worker.failed.connect(self.mesh_failed)
+        worker = self.mesh_worker
+        worker.finished.connect(lambda: self.mesh_finished(worker))
+        # Finished workers are not kept as children of the window.
+        worker.finished.connect(worker.deleteLater)
+        self.mesh_progress.setValue(0)
+        self.mesh_progress.show()
+        self.mesh_worker.start()
+
+    def mesh_finished(self, worker):
+        if self.mesh_worker is worker:
+            self.mesh_worker = None
+        pending, self.pending_mesh = self.pending_mesh, None
+        if pending is not None and pending == str(self.pid):
+            self.request_mesh()
+
+    def mesh_progressed(self, percent, message):
+        self.mesh_progress.setValue(percent)
+        self.mesh_progress.setFormat(f"Mesh: {message} %p%")
+        if percent == 100:
+            self.mesh_progress.hide()
+
+    def mesh_failed(self, pid, error):
+        self.mesh_progress.hide()
+        print(f"Error building mesh for {pid}\n{error}")
+
+    def show_mesh(self, pid, verts, faces, level):
+        if pid != str(self.pid):
+            return
+        self.mesh_view.setMesh(pid, verts, faces)
 
     def load_data(self, path_list):
-        self.revdata = DataLoader(path_list[0], path_list[1], path_list[2])
+        self.load_start = time.perf_counter()
+        if hasattr(self, "revdata"):
+            self.record_dwell()
+            self.revdata.close()
+        store = None
+        if self.shared_store:
+            store = SharedReviewStore(self.shared_store,
+                                      self.reviewer,
+                                      journal_mode=self.store_journal_mode)
+        self.revdata = DataLoader(path_list[0], path_list[1], path_list[2],
+                                  self.columnar, store,
+                                  telemetry=self.telemetry,
+                                  columns=self.qc_rules.columns)
+        self.lease_timer.stop()
+        if store is not None:
+            self.lease_timer.start(int(store.lease_seconds * 1000 / 4))
+        self.revdata.set_priority(self.priority_combobox.currentText())
+        self.update_sites()
+        self.filter_changed()
+        self.idx = -1
+        self.sort_changed(self.sort_combobox.currentText())
+        self.history = []
+        self.prefetcher.clear()
         print("Data Loaded")
 
+    def score_changed(self, column, score):
+        if hasattr(self, "revdata") and not self.loading_values:
+            self.revdata.set_value(self.idx, column, score)
+
+    def reason_changed(self, reason):
+        if (hasattr(self, "revdata") and not self.loading_values
+                and self.error_checkbox.isChecked()):
+            self.revdata.set_value(self.idx, "bp_err_reason", reason)
+
     def err_box_checked(self, state):
         if state == QtCore.Qt.Checked:
-            self.revdata.flagged_df.at[self.idx, "bp_seg_error"] = 1
+            self.revdata.set_value(self.idx, "bp_seg_error", 1)
+            self.reason_changed(self.reason_combobox.currentText())
         else:
-            self.revdata.flagged_df.at[self.idx, "bp_seg_error"] = 0
+            self.revdata.set_value(self.idx, "bp_seg_error", 0)
 
     def rev_box_checked(self, state):
         if state == QtCore.Qt.Checked:
-            self.revdata.flagged_df.at[self.idx, "bp_reviewed"] = 1
+            self.revdata.set_value(self.idx, "bp_reviewed", 1)
         else:
-            self.revdata.flagged_df.at[self.idx, "bp_reviewed"] = 0
+            self.revdata.set_value(self.idx, "bp_reviewed", 0)
 
     def inspect_checked(self, state):
         if state == QtCore.Qt.Checked:
-            self.revdata.flagged_df.at[self.idx, "bp_inspect"] = 1
+            self.revdata.set_value(self.idx, "bp_inspect", 1)
         else:
-            self.revdata.flagged_df.at[self.idx, "bp_inspect"] = 0
+            self.revdata.set_value(self.idx, "bp_inspect", 0)
+
+    def closeEvent(self, event):
+        if self.mesh_worker is not None and self.mesh_worker.isRunning():
+            # A running QThread destroyed with the window aborts the app.
+            self.pending_mesh = None
+            self.mesh_worker.requestInterruption()
+            self.mesh_worker.wait()
+        if hasattr(self, "revdata"):
+            self.record_dwell()
+            self.revdata.close()
+            print("Saved review csv")
+        print(self.telemetry.report())
+        self.telemetry.close()
+        super(MainWindow, self).closeEvent(event)
 
     def keyPressEvent(self, event):
-        if event.key() == QtCore.Qt.Key_E:
+        if event.matches(QtGui.QKeySequence.Save):
+            self.revdata.save_flagged_df(background=True)
+            print("Saving review csv")
+        elif event.key() == QtCore.Qt.Key_E:
             self.error_checkbox.toggle()
         elif event.key() == QtCore.Qt.Key_R:
             self.reviewed_checkbox.toggle()
@@ -274,6 +754,14 @@ class MainWindow(QWidget):
             self.prev_button_clicked()
         elif event.key() == QtCore.Qt.Key_N:
             self.next_button_clicked()
+        elif event.key() == QtCore.Qt.Key_F:
+            self.next_flagged_clicked()
+        elif event.key() == QtCore.Qt.Key_T:
+            self.stats_label.setVisible(not self.stats_label.isVisible())
+            self.stats_label.setText(self.telemetry.report())
+        elif event.key() == QtCore.Qt.Key_V:
+            self.view_tabs.setCurrentIndex(
+                (self.view_tabs.currentIndex() + 1) % self.view_tabs.count())
         elif event.key() == QtCore.Qt.Key_3:
             self.scale_leaks.lowest_button.setChecked(True)
         elif event.key() == QtCore.Qt.Key_2:
@@ -307,9 +795,84 @@ class MainWindow(QWidget):
 
 
 if __name__ == '__main__':
-    app = QApplication([])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prefetch-depth",
+                        type=int,
+                        default=3,
+                        help="Cases to prefetch either side of the current one.")
+    parser.add_argument("--prefetch-mb",
+                        type=int,
+                        default=512,
+                        help="Memory budget in MB for prefetched images.")
+    parser.add_argument("--mesh-step",
+                        type=int,
+                        default=1,
+                        help="Marching cubes step size for the 3D view.")
+    parser.add_argument("--mesh-downsample",
+                        type=int,
+                        default=1,
+                        help="Volume downsampling factor for the 3D view.")
+    parser.add_argument("--mesh-cache",
+                        type=str,
+                        default=str(DEFAULT_CACHE_DIR),
+                        help="Directory for cached 3D meshes.")
+    parser.add_argument("--mesh-coarse",
+                        type=int,
+                        default=4,
+                        help="Volume downsampling factor for the quick "
+                        "coarse mesh.")
+    parser.add_argument("--mesh-budget",
+                        type=int,
+                        default=200000,
+                        help="Triangle budget for the refined mesh.")
+    parser.add_argument("--no-refine",
+                        action="store_true",
+                        help="Only build the coarse mesh.")
+    parser.add_argument("--columnar",
+                        action="store_true",
+                        help="Keep a parquet copy of a csv summary and save "
+                        "only the review columns until exit.")
+    parser.add_argument("--shared-store",
+                        type=str,
+                        default=None,
+                        help="SQLite review store shared between reviewers.")
+    parser.add_argument("--store-journal-mode",
+                        choices=["WAL", "DELETE"],
+                        default="WAL",
+                        help="SQLite journal mode of the shared store; use "
+                        "DELETE when the store is on a network share.")
+    parser.add_argument("--reviewer",
+                        type=str,
+                        default=None,
+                        help="Reviewer name for the shared store, defaults "
+                        "to the login name.")
+    parser.add_argument("--paths",
+                        nargs=3,
+                        metavar=("IMAGES", "SEGMENTATIONS", "SUMMARY"),
+                        help="Load these paths and show the first case "
+                        "without the selection dialog.")
+    parser.add_argument("--qc-rules",
+                        type=str,
+                        default=str(DEFAULT_RULES),
+                        help="YAML file of QC rules used to colour the values.")
+    parser.add_argument("--trace",
+                        type=str,
+                        default=None,
+                        help="Write a Chrome trace of UI timings to this file.")
+    args, qt_args = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qt_args)
     app.setApplicationName("Segment Sure")
-    reviewer = MainWindow()
+    reviewer = MainWindow(args.prefetch_depth, args.prefetch_mb,
+                          args.mesh_step, args.mesh_downsample,
+                          args.mesh_cache, args.mesh_coarse, args.mesh_budget,
+                          not args.no_refine, args.columnar, args.shared_store,
+                          args.store_journal_mode, args.reviewer,
+                          args.qc_rules, args.trace)
     # reviewer = QLabel("Hello World")
     reviewer.show()
+    print(f"Window ready {time.perf_counter() - START_TIME:.2f}s after start")
+    if args.paths:
+        reviewer.load_data(args.paths)
+        reviewer.next_button_clicked()
     app.exec()
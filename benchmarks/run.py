@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# Run from the repository root: python -m benchmarks.run
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.synthetic import write_cohort
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+DEFAULT_COHORT = Path(tempfile.gettempdir()) / "segsure_bench_cohort"
+
+
+def _copy_summary(cohort: Path, name: str, work: Path) -> Path:
+    # Benchmarks that save work on a copy, so every repeat starts the same.
+    path = work / name
+    shutil.copy(cohort / name, path)
+    return path
+
+
+def bench_load(cohort: Path, work: Path, rows: int) -> float:
+    from src.dataloader import DataLoader
+    summary = _copy_summary(cohort, f"summary_{rows}.csv", work)
+    start = time.perf_counter()
+    loader = DataLoader(cohort / f"images_{rows}", cohort / "segmentations",
+                        summary)
+    loader.image_index.wait()
+    elapsed = time.perf_counter() - start
+    loader.journal.close()
+    return elapsed
+
+
+def bench_index(cohort: Path, work: Path, rows: int) -> float:
+    from src.dataloader import PidIndex
+    start = time.perf_counter()
+    PidIndex(cohort / f"images_{rows}", "image").wait()
+    return time.perf_counter() - start
+
+
+def bench_navigation(cohort: Path, work: Path, rows: int,
+                     steps: int = 1000) -> float:
+    """
+    The data side of reviewing cases: next case from the queue, then the
+    review columns load_case sets.
+    """
+    from src.dataloader import DataLoader
+    summary = _copy_summary(cohort, f"summary_{rows}.csv", work)
+    loader = DataLoader(None, None, summary)
+    idx = -1
+    start = time.perf_counter()
+    for _ in range(steps):
+        idx = loader.active_queue().next(exclude=idx)
+        if idx is None:
+            break
+        loader.set_value(idx, "bp_leak_score", 2)
+        loader.set_value(idx, "bp_segmental_score", 2)
+        loader.set_value(idx, "bp_subsegmental_score", 2)
+        loader.set_value(idx, "bp_reviewed", 1)
+    elapsed = time.perf_counter() - start
+    loader.journal.close()
+    return elapsed
+
+
+def bench_save(cohort: Path, work: Path, rows: int) -> float:
+    from src.dataloader import DataLoader
+    summary = _copy_summary(cohort, f"summary_{rows}.csv", work)
+    loader = DataLoader(None, None, summary)
+    loader.set_value(0, "bp_reviewed", 1)
+    start = time.perf_counter()
+    loader.save_flagged_df()
+    elapsed = time.perf_counter() - start
+    loader.journal.close()
+    return elapsed
+
+
+def bench_flag_qc(cohort: Path, work: Path, rows: int) -> float:
+    from src.qc import DEFAULT_RULES
+    from utils import check_seg_error_from_csv
+    start = time.perf_counter()
+    check_seg_error_from_csv.main(
+        Namespace(input_csv=cohort / f"summary_{rows}.csv",
+                  output_csv=work / "flagged.csv",
+                  rules=DEFAULT_RULES,
+                  stream=0))
+    return time.perf_counter() - start
+
+
+def bench_flag_lobes(cohort: Path, work: Path, warm: bool = False) -> float:
+    """
+    The discontinuity check, building the lobe count table from every pickle,
+    or with warm, reusing a table that is already up to date.
+    """
+    from utils import check_for_discontinuity
+    args = Namespace(merged_csv=cohort / "summary_pickled.csv",
+                     pickle_dir=cohort / "pickles",
+                     output_csv=work / "flagged.csv",
+                     table=work / "lobe_counts.parquet",
+                     stream=0,
+                     workers=os.cpu_count(),
+                     chunksize=64)
+    if warm:
+        check_for_discontinuity.main(args)
+    start = time.perf_counter()
+    check_for_discontinuity.main(args)
+    return time.perf_counter() - start
+
+
+def bench_flag_lobes_warm(cohort: Path, work: Path) -> float:
+    return bench_flag_lobes(cohort, work, warm=True)
+
+
+def _masks(cohort: Path) -> list:
+    return sorted((cohort / "segmentations").iterdir())
+
+
+def bench_crop(cohort: Path, work: Path) -> float:
+    import nibabel as nib
+    from src.crop import crop
+    volumes = [np.asanyarray(nib.load(p).dataobj) for p in _masks(cohort)]
+    start = time.perf_counter()
+    for volume in volumes:
+        crop(volume, padding=4)
+    return time.perf_counter() - start
+
+
+def bench_crop_load(cohort: Path, work: Path, coarse_step: int = None) -> float:
+    from src.crop import load_cropped
+    start = time.perf_counter()
+    for path in _masks(cohort):
+        load_cropped(path, 4, coarse_step)
+    return time.perf_counter() - start
+
+
+def bench_crop_load_coarse(cohort: Path, work: Path) -> float:
+    return bench_crop_load(cohort, work, coarse_step=4)
+
+
+def bench_thumbnail(cohort: Path, work: Path) -> float:
+    from utils.seg_thumbnail import process_segmentation
+    start = time.perf_counter()
+    for path in _masks(cohort):
+        process_segmentation(path, lean=True, output_dir=work)
+    return time.perf_counter() - start
+
+
+def bench_mesh(cohort: Path, work: Path) -> float:
+    from src.meshing import build_mesh, decimate, load_mask
+    start = time.perf_counter()
+    for path in _masks(cohort):
+        verts, faces = build_mesh(load_mask(str(path)))
+        decimate(verts, faces, 200000)
+    return time.perf_counter() - start
+
+
+# Benchmarks run once per summary size.
+PER_SIZE = {
+    "load": bench_load,
+    "index": bench_index,
+    "navigation": bench_navigation,
+    "save": bench_save,
+    "flag_qc": bench_flag_qc,
+}
+
+# Benchmarks run once on the segmentations or pickles.
+ONCE = {
+    "flag_lobes": bench_flag_lobes,
+    "flag_lobes_warm": bench_flag_lobes_warm,
+    "crop": bench_crop,
+    "crop_load": bench_crop_load,
+    "crop_load_coarse": bench_crop_load_coarse,
+    "thumbnail": bench_thumbnail,
+    "mesh": bench_mesh,
+}
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux; worker processes count as children.
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / 1024
+
+
+def _run_child(name: str, cohort: str, rows: int, verbose: bool, conn):
+    if not verbose:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+    try:
+        function = PER_SIZE.get(name) or ONCE[name]
+        with tempfile.TemporaryDirectory() as work:
+            args = (Path(cohort), Path(work)) + ((rows, ) if rows else ())
+            seconds = function(*args)
+        conn.send((seconds, _peak_rss_mb(), None))
+    except Exception as e:
+        conn.send((None, None, f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def run_benchmark(name: str, cohort: Path, rows: int = None,
+                  repeat: int = 3, verbose: bool = False) -> dict:
+    """
+    Runs a benchmark repeat times, each in a fresh process so peak RSS and
+    import caches are its own. The process is not a pool worker, so the
+    benchmarked code can start process pools of its own.
+    :return: Fastest wall time and largest peak RSS.
+    """
+    context = mp.get_context("spawn")
+    seconds, peaks = [], []
+    for _ in range(repeat):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_run_child,
+                                  args=(name, str(cohort), rows, verbose,
+                                        sender))
+        process.start()
+        sender.close()
+        try:
+            elapsed, peak, error = receiver.recv()
+        except EOFError:
+            elapsed, peak, error = None, None, "benchmark process died"
+        finally:
+            receiver.close()
+            process.join()
+        if error is not None:
+            raise RuntimeError(f"{error} (exit code {process.exitcode})")
+        seconds.append(elapsed)
+        peaks.append(peak)
+    return {
+        "seconds": min(seconds),
+        "all_seconds": seconds,
+        "peak_rss_mb": max(peaks)
+    }
+
+
+def git_state() -> dict:
+    def _git(*args):
+        result = subprocess.run(["git", *args],
+                                capture_output=True,
+                                text=True,
+                                cwd=Path(__file__).resolve().parent)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    return {
+        "commit": _git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no"))
+    }
+
+
+def compare(results: dict, baseline_path, threshold: float) -> int:
+    """
+    Prints wall time ratios against a saved run.
+    :return: Number of benchmarks slower than threshold times the baseline.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline["cohort"] != results["cohort"]:
+        print("Warning: the baseline was run on a different cohort")
+    print(f"Compared with {baseline['git']['commit']}:")
+    regressions = 0
+    for name, result in results["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        ratio = result["seconds"] / old["seconds"] if old["seconds"] else 1.0
+        marker = ""
+        if ratio > threshold:
+            marker = "  REGRESSION"
+            regressions += 1
+        print(f"  {name:28s} {old['seconds']:8.3f}s -> "
+              f"{result['seconds']:8.3f}s  x{ratio:.2f}{marker}")
+    return regressions
+
+
+def main(args):
+    rows = [int(n) for n in args.rows.split(",")]
+    shape = tuple(int(n) for n in args.shape.split("x"))
+    start = time.perf_counter()
+    cohort = write_cohort(args.cohort_dir, rows, args.masks, shape,
+                          args.pickles, args.compressed, args.seed)
+    print(f"Cohort ready in {args.cohort_dir} "
+          f"({time.perf_counter() - start:.1f}s)")
+
+    selected = set(args.only.split(",")) if args.only else None
+    jobs = [(f"{name}[{n}]", name, n) for name in PER_SIZE for n in rows]
+    jobs += [(name, name, None) for name in ONCE]
+    results = {}
+    for label, name, n in jobs:
+        if selected and name not in selected:
+            continue
+        try:
+            results[label] = run_benchmark(name, args.cohort_dir, n,
+                                           args.repeat, args.verbose)
+        except Exception as e:
+            print(f"{label:28s} failed: {type(e).__name__}: {e}")
+            continue
+        print(f"{label:28s} {results[label]['seconds']:8.3f}s  "
+              f"peak RSS {results[label]['peak_rss_mb']:7.0f} MB")
+
+    report = {
+        "git": git_state(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "cohort": cohort,
+        "results": results
+    }
+    output = Path(args.output or RESULTS_DIR /
+                  f"{report['git']['commit'] or 'unknown'}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+
+    if args.compare:
+        regressions = compare(report, args.compare, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Times SegSure's data paths on a synthetic cohort.")
+    parser.add_argument("--cohort-dir",
+                        type=Path,
+                        default=DEFAULT_COHORT,
+                        help="Where the synthetic cohort is generated and "
+                        "reused.")
+    parser.add_argument("--rows",
+                        type=str,
+                        default="1000,10000,100000",
+                        help="Comma separated summary sizes.")
+    parser.add_argument("--masks",
+                        type=int,
+                        default=4,
+                        help="Number of synthetic segmentations.")
+    parser.add_argument("--shape",
+                        type=str,
+                        default="320x320x400",
+                        help="Segmentation volume shape, XxYxZ.")
+    parser.add_argument("--pickles",
+                        type=int,
+                        default=1000,
+                        help="Number of synthetic lobe pickles.")
+    parser.add_argument("--compressed",
+                        action="store_true",
+                        help="Write .nii.gz segmentations instead of .nii.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=3,
+                        help="Runs per benchmark; the fastest is reported.")
+    parser.add_argument("--only",
+                        type=str,
+                        default=None,
+                        help="Comma separated benchmark names to run.")
+    parser.add_argument("--output",
+                        type=str,
+                        default=None,
+                        help="Results file, benchmarks/results/<commit>.json "
+                        "by default.")
+    parser.add_argument("--compare",
+                        type=str,
+                        default=None,
+                        help="Earlier results file to compare against; exits "
+                        "with 1 on a regression.")
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=1.2,
+                        help="Slowdown ratio counted as a regression.")
+    parser.add_argument("--verbose",
+                        action="store_true",
+                        help="Show the output of the benchmarked code.")
+    args = parser.parse_args()
+
+    main(args)
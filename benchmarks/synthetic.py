@@ -0,0 +1,169 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.columnar import ERROR_REASONS
+
+LOBES = ["LUL", "LLL", "RUL", "RML", "RLL"]
+FIRST_PID = 100000
+
+
+def participant_ids(n: int) -> np.ndarray:
+    return np.arange(FIRST_PID, FIRST_PID + n)
+
+
+def summary(n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Summary table with the measured values and review columns of n cases.
+    About a fifth of the cases are already reviewed.
+    """
+    rng = np.random.default_rng(seed)
+    reviewed = rng.random(n) < 0.2
+    seg_error = (rng.random(n) < 0.15).astype(np.int64)
+    reasons = np.where(reviewed & (seg_error == 1),
+                       rng.choice(ERROR_REASONS, n), "")
+
+    def _scores():
+        return np.where(reviewed, rng.integers(0, 4, n), -1)
+
+    return pd.DataFrame({
+        "participant_id": participant_ids(n),
+        "bp_tlv": rng.normal(5.5, 1.2, n).round(3),
+        "bp_airvol": rng.normal(0.2, 0.07, n).round(4),
+        "bp_tcount": rng.normal(270, 60, n).round().astype(np.int64),
+        "bp_seg_error": seg_error,
+        "bp_reviewed": reviewed.astype(np.int64),
+        "bp_err_reason": reasons,
+        "bp_leak_score": _scores(),
+        "bp_segmental_score": _scores(),
+        "bp_subsegmental_score": _scores(),
+        "bp_inspect": (rng.random(n) < 0.05).astype(np.int64),
+    })
+
+
+def _draw_segment(mask: np.ndarray, start: np.ndarray, end: np.ndarray,
+                  radius: float):
+    # Sets every voxel within radius of the segment, working on its bounding
+    # box only.
+    low = np.maximum(np.floor(np.minimum(start, end) - radius), 0).astype(int)
+    high = np.minimum(np.ceil(np.maximum(start, end) + radius) + 1,
+                      mask.shape).astype(int)
+    if np.any(high <= low):
+        return
+    grid = np.ogrid[tuple(slice(a, b) for a, b in zip(low, high))]
+    direction = end - start
+    length2 = max(float(direction @ direction), 1e-9)
+    offsets = [g - s for g, s in zip(grid, start)]
+    t = sum(o * d for o, d in zip(offsets, direction)) / length2
+    t = np.clip(t, 0, 1)
+    dist2 = sum((o - t * d)**2 for o, d in zip(offsets, direction))
+    mask[tuple(slice(a, b) for a, b in zip(low, high))] |= dist2 <= radius**2
+
+
+def tubular_tree(shape: tuple = (320, 320, 400), depth: int = 8,
+                 seed: int = 0) -> np.ndarray:
+    """
+    Airway-like binary tree of tubes, each generation narrower and shorter
+    and turned by a random angle.
+    :param shape: Volume shape, z being the cranio-caudal axis.
+    :param depth int: Branching generations.
+    :return: uint8 mask
+    """
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=bool)
+    size = np.array(shape, dtype=np.float64)
+
+    def _grow(start, direction, length, radius, level):
+        end = np.clip(start + direction * length, 0, size - 1)
+        _draw_segment(mask, start, end, radius)
+        if level == depth:
+            return
+        for sign in (-1, 1):
+            axis = np.cross(direction, rng.normal(size=3))
+            axis /= np.linalg.norm(axis)
+            angle = sign * rng.uniform(0.35, 0.7)
+            turned = (direction * np.cos(angle) +
+                      np.cross(axis, direction) * np.sin(angle))
+            _grow(end, turned, length * rng.uniform(0.7, 0.85),
+                  max(radius * 0.75, 1.0), level + 1)
+
+    trunk = np.array([size[0] / 2, size[1] / 2, size[2] * 0.9])
+    _grow(trunk, np.array([0.0, 0.0, -1.0]), size[2] * 0.25,
+          max(size[0] * 0.025, 1.5), 0)
+    return mask.astype(np.uint8)
+
+
+def lobe_table(seed: int, discontinuous: bool = False) -> pd.DataFrame:
+    """
+    Branch table of one participant in the layout lobe_counts reads.
+    Discontinuous cases are missing a lobe.
+    """
+    rng = np.random.default_rng(seed)
+    lobes = LOBES[:-1] if discontinuous else LOBES
+    n = int(rng.integers(200, 400))
+    labels = rng.choice(lobes + [""], n)
+    return pd.DataFrame({
+        "branch": np.arange(n),
+        "length": rng.gamma(2.0, 4.0, n).round(2),
+        "lobes": labels,
+    })
+
+
+def write_cohort(cohort_dir, rows=(1000, 10000, 100000), masks: int = 4,
+                 shape: tuple = (320, 320, 400), pickles: int = 1000,
+                 compressed: bool = False, seed: int = 0) -> dict:
+    """
+    Writes a synthetic cohort, unless one with the same settings is already
+    there:
+        summary_{n}.csv and images_{n}/ (empty {pid}.jpg files) per row count,
+        segmentations/ with tubular tree masks for the first cases,
+        pickles/ with lobe tables and summary_pickled.csv listing their cases.
+    :return: The cohort settings.
+    """
+    import nibabel as nib
+
+    cohort_dir = Path(cohort_dir)
+    settings = {
+        "rows": sorted(rows),
+        "masks": masks,
+        "shape": list(shape),
+        "pickles": pickles,
+        "compressed": compressed,
+        "seed": seed
+    }
+    settings_path = cohort_dir / "cohort.json"
+    if settings_path.is_file():
+        with open(settings_path) as f:
+            if json.load(f) == settings:
+                return settings
+    cohort_dir.mkdir(parents=True, exist_ok=True)
+
+    for n in settings["rows"]:
+        df = summary(n, seed)
+        df.to_csv(cohort_dir / f"summary_{n}.csv", index=False)
+        image_dir = cohort_dir / f"images_{n}"
+        image_dir.mkdir(exist_ok=True)
+        for pid in df.participant_id:
+            (image_dir / f"{pid}.jpg").touch()
+
+    seg_dir = cohort_dir / "segmentations"
+    seg_dir.mkdir(exist_ok=True)
+    suffix = ".nii.gz" if compressed else ".nii"
+    for i, pid in enumerate(participant_ids(masks)):
+        image = nib.Nifti1Image(tubular_tree(shape, seed=seed + i), np.eye(4))
+        nib.save(image, seg_dir / f"{pid}{suffix}")
+
+    pickle_dir = cohort_dir / "pickles"
+    pickle_dir.mkdir(exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i, pid in enumerate(participant_ids(pickles)):
+        table = lobe_table(seed + i, discontinuous=rng.random() < 0.05)
+        table.to_pickle(pickle_dir / f"{pid}_branches.pkl")
+    summary(pickles, seed).to_csv(cohort_dir / "summary_pickled.csv",
+                                  index=False)
+
+    with open(settings_path, "w") as f:
+        json.dump(settings, f, indent=2)
+    return settings
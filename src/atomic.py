@@ -0,0 +1,21 @@
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yields a temporary path next to path and renames it over path once the
+    block finishes, so an interrupted write never leaves a truncated file.
+    The temporary file keeps the suffix, for writers that go by it, and is
+    removed if the block raises.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.stem}.tmp{path.suffix}")
+    try:
+        yield tmp_path
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
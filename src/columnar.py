@@ -0,0 +1,146 @@
+import json
+from pathlib import Path
+
+import pandas as pd
+
+from src.atomic import atomic_path
+
+ERROR_REASONS = ["Discontinuous", "Leak", "Expiratory", "Other"]
+
+# Review columns with their defaults and on-disk dtypes.
+REVIEW_COLUMNS = {
+    "bp_reviewed": (0, "int8"),
+    "bp_seg_error": (0, "int8"),
+    "bp_inspect": (0, "int8"),
+    "bp_leak_score": (-1, "int8"),
+    "bp_segmental_score": (-1, "int8"),
+    "bp_subsegmental_score": (-1, "int8"),
+    "bp_err_reason": ("", "category"),
+    # Seconds the reviewer spent on the case, summed over visits.
+    "bp_dwell_s": (0.0, "float32"),
+}
+
+# Review columns measured rather than judged; not compared between reviewers.
+TIMING_COLUMNS = ["bp_dwell_s"]
+
+# Summary columns the reviewer reads besides the review columns, when
+# present. Columns QC rules check are added by the caller.
+VIEW_COLUMNS = ["participant_id", "site", "bp_tlv", "bp_airvol", "bp_tcount",
+                "bp_qc_reasons"]
+
+COLUMNAR_SUFFIXES = (".parquet", ".feather")
+
+
+def is_columnar(path) -> bool:
+    return Path(path).suffix in COLUMNAR_SUFFIXES
+
+
+def read_table(path, columns=None) -> pd.DataFrame:
+    """
+    Reads a Parquet or Feather table, only loading the requested columns.
+    Columns missing from the file are skipped.
+    """
+    path = Path(path)
+    if columns is not None:
+        available = set(table_columns(path))
+        columns = [c for c in columns if c in available]
+    if path.suffix == ".feather":
+        return pd.read_feather(path, columns=columns)
+    return pd.read_parquet(path, columns=columns)
+
+
+def table_columns(path) -> list:
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+    path = Path(path)
+    if path.suffix == ".feather":
+        return feather.read_table(path, memory_map=True).column_names
+    return pq.read_schema(path).names
+
+
+def write_table(df: pd.DataFrame, path):
+    """
+    Writes a Parquet or Feather table via a temporary file and rename.
+    """
+    path = Path(path)
+    with atomic_path(path) as tmp_path:
+        if path.suffix == ".feather":
+            df.reset_index(drop=True).to_feather(tmp_path)
+        else:
+            df.to_parquet(tmp_path, index=False)
+
+
+def review_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Casts the review columns to their explicit dtypes, filling defaults.
+    """
+    for column, (default, dtype) in REVIEW_COLUMNS.items():
+        values = df.get(column, default)
+        if dtype == "category":
+            values = pd.Series(values, index=df.index).fillna(default)
+            values = values.astype(str)
+            categories = [""] + ERROR_REASONS
+            categories += sorted(set(values.unique()) - set(categories))
+            df[column] = pd.Categorical(values, categories=categories)
+        else:
+            values = pd.Series(values, index=df.index).fillna(default)
+            df[column] = values.astype(dtype)
+    return df
+
+
+def source_path(table_path) -> Path:
+    """
+    Record of the csv a columnar summary was converted from.
+    """
+    table_path = Path(table_path)
+    return table_path.with_name(f"{table_path.stem}.source.json")
+
+
+def csv_signature(csv_path) -> dict:
+    stat = Path(csv_path).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def mark_source(csv_path, table_path):
+    """
+    Records csv_path as matching table_path, e.g. after exporting the csv
+    from the table, so the next ensure_columnar keeps the table.
+    """
+    with open(source_path(table_path), "w") as f:
+        json.dump(csv_signature(csv_path), f)
+
+
+def ensure_columnar(csv_path, suffix: str = ".parquet") -> Path:
+    """
+    Converts a summary csv to a columnar copy next to it, unless an up to date one exists.
+    The copy is up to date while the csv keeps the size and mtime recorded at
+    conversion or export.
+    :return: Path of the columnar summary.
+    """
+    csv_path = Path(csv_path)
+    table_path = csv_path.with_suffix(suffix)
+    recorded = None
+    if source_path(table_path).is_file():
+        with open(source_path(table_path)) as f:
+            recorded = json.load(f)
+    if not table_path.is_file():
+        stale = True
+    elif recorded is not None:
+        stale = recorded != csv_signature(csv_path)
+    else:
+        # Copies made before the source record existed.
+        stale = table_path.stat().st_mtime < csv_path.stat().st_mtime
+    if stale:
+        print(f"Converting {csv_path.name} to {table_path.name}")
+        write_table(review_dtypes(pd.read_csv(csv_path)), table_path)
+    if stale or recorded is None:
+        mark_source(csv_path, table_path)
+    return table_path
+
+
+def review_path(table_path) -> Path:
+    """
+    Sidecar holding only participant_id and the review columns.
+    """
+    table_path = Path(table_path)
+    return table_path.with_name(f"{table_path.stem}.review{table_path.suffix}")
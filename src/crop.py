@@ -0,0 +1,90 @@
+from typing import Optional
+
+import numpy as np
+
+
+def bounding_box(mask: np.ndarray, padding=0, step: int = 1) -> Optional[tuple]:
+    """
+    Bounding box of the non-zero voxels from np.any projections, without a
+    coordinate array: two passes over the volume whatever its size.
+    :param mask: Array of any dtype; non-zero voxels are foreground.
+    :param padding: Voxels added on each side, one int or one per axis,
+        clipped to the volume.
+    :param step int: Only look at every step-th voxel along each axis. The box
+        is widened by step - 1 to cover the voxels skipped at its edges, but
+        structures thinner than step outside it can be missed.
+    :return: tuple of slices, or None for an empty mask.
+    """
+    padding = np.broadcast_to(padding, (mask.ndim, ))
+    shape = mask.shape
+    if step > 1:
+        mask = mask[(slice(None, None, step), ) * mask.ndim]
+    # Reducing the last axis once serves every other axis.
+    rest = mask.any(axis=-1)
+    profiles = [
+        rest.any(axis=tuple(a for a in range(rest.ndim) if a != axis))
+        for axis in range(rest.ndim)
+    ]
+    profiles.append(mask.any(axis=tuple(range(mask.ndim - 1))))
+
+    box = []
+    for axis, profile in enumerate(profiles):
+        nonzero = np.flatnonzero(profile)
+        if nonzero.size == 0:
+            return None
+        lower = nonzero[0] * step - (step - 1) - padding[axis]
+        upper = nonzero[-1] * step + step + padding[axis]
+        box.append(slice(int(max(lower, 0)), int(min(upper, shape[axis]))))
+    return tuple(box)
+
+
+def crop(mask: np.ndarray, padding=0, step: int = 1) -> np.ndarray:
+    """
+    View of mask cropped to its bounding box; an empty view for an empty mask.
+    """
+    box = bounding_box(mask, padding, step)
+    if box is None:
+        return mask[(slice(0, 0), ) * mask.ndim]
+    return mask[box]
+
+
+def load_cropped(path, padding=0, coarse_step: int = None) -> tuple:
+    """
+    Loads the bounding box region of a nifti segmentation in its native dtype.
+    With coarse_step, the box is first found on a strided read through the
+    header-described array proxy, and then only that region is read and
+    scanned exactly. For large uncompressed volumes this reads a fraction of
+    the file; see bounding_box for what a coarse scan can miss.
+    :param path: Nifti path.
+    :param padding: Voxels added on each side, one int or one per axis.
+    :param coarse_step int: Stride of the coarse scan, or None to scan everything.
+    :return: (cropped array, tuple of slices into the full volume or None)
+    """
+    import nibabel as nib
+    proxy = nib.load(path).dataobj
+    ndim = len(proxy.shape)
+    if not coarse_step or coarse_step < 2:
+        data = np.asanyarray(proxy)
+        box = bounding_box(data, padding)
+        if box is None:
+            return data[(slice(0, 0), ) * ndim], None
+        return data[box], box
+
+    strided = np.asanyarray(proxy[(slice(None, None, coarse_step), ) * ndim])
+    coarse = bounding_box(strided, 0)
+    if coarse is None:
+        return np.zeros((0, ) * ndim, dtype=strided.dtype), None
+    # Scale to full resolution, keeping the padding inside the region read.
+    padding = np.broadcast_to(padding, (ndim, ))
+    region = tuple(
+        slice(max(s.start * coarse_step - (coarse_step - 1) - p, 0),
+              min((s.stop - 1) * coarse_step + coarse_step + p, size))
+        for s, p, size in zip(coarse, padding, proxy.shape))
+    data = np.asanyarray(proxy[region])
+    inner = bounding_box(data, padding)
+    if inner is None:
+        return data[(slice(0, 0), ) * ndim], None
+    box = tuple(
+        slice(r.start + i.start, r.start + i.stop)
+        for r, i in zip(region, inner))
+    return data[inner], box
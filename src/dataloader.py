@@ -1,29 +1,465 @@
+import os
+import re
+import threading
+import time
+from collections import defaultdict
 from pathlib import Path
+from typing import Iterable, Optional
+import numpy as np
 import pandas as pd
 
+from src.atomic import atomic_path
+from src.columnar import (REVIEW_COLUMNS, VIEW_COLUMNS, ensure_columnar,
+                          is_columnar, mark_source, read_table, review_dtypes,
+                          review_path, write_table)
+from src.journal import ReviewJournal
+from src.review_queue import PRIORITIES, ReviewQueue
+from src.sampling import draw_sample, save_manifest
+
+PID_PATTERN = re.compile(r"\d{6}")
+
+# Written next to the segmentation directory by utils/geometry_metrics.py
+METRICS_NAME = "geometry_metrics.parquet"
+# Thumbnail names and preview subdirectory written by utils/seg_thumbnail.py
+IMAGE_PATTERNS = ["{pid}.jpg", "{pid}.webp", "{pid}.png"]
+PREVIEW_DIR = "previews"
+
+
+def parse_pid(path) -> Optional[str]:
+    """
+    Extracts the participant ID from a file name.
+    :param path: File path or name.
+    :return: The first 6 digit run in the file name, or None.
+    """
+    match = PID_PATTERN.search(Path(path).name)
+    return match.group() if match else None
+
+
+def pid_key(pid) -> str:
+    """
+    Normalises a participant ID from the summary to an index key.
+    """
+    return str(pid).strip().zfill(6)
+
+
+class PidIndex():
+
+    def __init__(self, directory: str, label: str = "file",
+                 name_patterns: Iterable[str] = ()):
+        """
+        Participant ID -> path index of one directory, built with os.scandir
+        on a background thread. Lookups return as soon as their file is seen.
+        Duplicates keep the first path in sorted order and are reported.
+        :param directory str: Directory to index, or None for an empty index.
+        :raises NotADirectoryError: The directory does not exist.
+        :param label str: Name used when reporting problems.
+        :param name_patterns: Likely file names, e.g. "{pid}.jpg", tried
+            directly while the scan is still running.
+        """
+        self.directory = directory
+        self.label = label
+        self.name_patterns = list(name_patterns)
+        self.paths = {}
+        self.duplicates = {}
+        self.unmatched = 0
+        self.error = None
+        self.done = threading.Event()
+        self._changed = threading.Condition()
+        if directory is None:
+            # Headless use without files; every lookup misses.
+            self.done.set()
+            return
+        if not os.path.isdir(directory):
+            raise NotADirectoryError(f"{label} directory {directory} not found")
+        self._thread = threading.Thread(target=self._scan, daemon=True)
+        self._thread.start()
+
+    def _scan(self):
+        try:
+            with os.scandir(self.directory) as entries:
+                for n, entry in enumerate(entries):
+                    if not entry.is_file():
+                        continue
+                    pid = parse_pid(entry.name)
+                    if pid is None:
+                        self.unmatched += 1
+                    elif pid in self.paths:
+                        self.duplicates.setdefault(pid, [self.paths[pid]])
+                        self.duplicates[pid].append(entry.path)
+                        self.paths[pid] = min(self.paths[pid], entry.path)
+                    else:
+                        self.paths[pid] = entry.path
+                    if n % 256 == 0:
+                        with self._changed:
+                            self._changed.notify_all()
+        except OSError as e:
+            # Raised again from get() and wait() rather than leaving them
+            # waiting for a scan that will never finish.
+            self.error = e
+        finally:
+            with self._changed:
+                self.done.set()
+                self._changed.notify_all()
+        if self.error is None:
+            self.report()
+
+    def report(self):
+        if self.unmatched:
+            print(f"{self.unmatched} {self.label} files without a "
+                  f"participant id")
+        if self.duplicates:
+            print(f"{len(self.duplicates)} participant ids with duplicate "
+                  f"{self.label} files, using the first of each:")
+            for pid, dups in self.duplicates.items():
+                print(f"  {pid}: {', '.join(Path(d).name for d in sorted(dups))}")
+
+    def get(self, pid: str, wait: bool = True) -> Optional[str]:
+        """
+        Returns the path for a participant ID key, or None.
+        :param wait bool: Wait for the scan to reach the file if needed.
+        :raises OSError: The directory could not be scanned.
+        """
+        if self.error is not None:
+            raise self.error
+        path = self.paths.get(pid)
+        if path is not None or self.done.is_set() or not wait:
+            return path
+        for pattern in self.name_patterns:
+            candidate = os.path.join(self.directory, pattern.format(pid=pid))
+            if os.path.isfile(candidate):
+                return candidate
+        with self._changed:
+            self._changed.wait_for(
+                lambda: pid in self.paths or self.done.is_set())
+        if self.error is not None and pid not in self.paths:
+            raise self.error
+        return self.paths.get(pid)
+
+    def wait(self) -> dict:
+        """
+        Waits for the scan to finish and returns the full index.
+        :raises OSError: The directory could not be scanned.
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.paths
+
+
+def merge_reviews(df: pd.DataFrame, reviews: pd.DataFrame):
+    """
+    Overwrites the review columns of df with those of matching reviews rows.
+    Missing values in reviews leave df as it is.
+    :param df: Summary dataframe, modified in place.
+    :param reviews: participant_id plus the review columns to copy.
+    """
+    reviews = reviews.set_index(reviews.participant_id.map(pid_key))
+    reviews = reviews[~reviews.index.duplicated(keep="last")]
+    keys = df.participant_id.map(pid_key)
+    for column in reviews.columns.drop("participant_id"):
+        values = reviews[column].dropna().astype(object)
+        known = keys.isin(values.index)
+        df.loc[known, column] = keys[known].map(values).to_numpy()
+
 
 class DataLoader():
 
-    def __init__(self, image_dir: str, seg_dir: str, summary_path: str):
+    def __init__(self,
+                 image_dir: str,
+                 seg_dir: str,
+                 summary_path: str,
+                 columnar: bool = False,
+                 shared_store=None,
+                 metrics_path: str = None,
+                 telemetry=None,
+                 columns: Iterable[str] = ()):
         """
         Loads the images, segmentations and summary dataframes.
-        :param image_dir str: Path containing segmentation images.
-        :param seg_dir str: Path containing nifti format segmentations.
-        :param summary_path str: Summary csv path.
+        :param image_dir str: Path containing segmentation images, or None.
+        :param seg_dir str: Path containing nifti format segmentations, or None.
+        :param summary_path str: Summary csv, parquet or feather path.
+        :param columnar bool: Use a parquet copy of a csv summary, with the
+            review columns saved to a separate sidecar.
+        :param shared_store: SharedReviewStore to claim cases from and commit
+            reviews to, instead of writing the summary.
+        :param metrics_path str: Geometry metrics table, by default
+            geometry_metrics.parquet next to seg_dir when it exists.
+        :param telemetry: Optional Telemetry timing summary saves.
+        :param columns: Summary columns to load besides VIEW_COLUMNS from a
+            columnar summary, e.g. QCRules.columns.
         """
-        self.image_list = [
-            str(i) for i in Path(image_dir).iterdir() if i.is_file()
-        ]
-        self.summary_df = pd.read_csv(summary_path)
-        self.seg_list = [
-            str(s) for s in Path(seg_dir).iterdir() if s.is_file()
-        ]
+        # Review column -> participant keys a reviewer changed, which are
+        # the only cells the columnar review sidecar holds.
+        self.edited = defaultdict(set)
+        # Participant keys changed since their review was last committed to
+        # the shared store.
+        self.uncommitted = set()
+        self.image_index = PidIndex(image_dir, "image", IMAGE_PATTERNS)
+        preview_dir = os.path.join(image_dir or "", PREVIEW_DIR)
+        self.preview_index = (PidIndex(preview_dir, "preview", IMAGE_PATTERNS)
+                              if image_dir and os.path.isdir(preview_dir)
+                              else None)
+        self.seg_index = PidIndex(seg_dir, "segmentation")
+        self.columnar = columnar or is_columnar(summary_path)
+        if self.columnar:
+            self.load_columnar(summary_path, columns)
+        else:
+            self.summary_df = pd.read_csv(summary_path)
 
         self.save_path = Path(summary_path)
+        self._save_thread = None
+        self.telemetry = telemetry
+        if metrics_path is None and seg_dir is not None:
+            metrics_path = Path(seg_dir).parent / METRICS_NAME
+        self.load_metrics(metrics_path)
+        self.store = shared_store
+        self.priority = "Flagged first"
+        # (geometry metric, ascending) the queue is ordered by, or None.
+        self.sort_metric = None
+        self.queue_filter = None
+        self.queue_reviewed = True
+        # Participant key -> position in the order flagged_df was built in.
+        self._default_rank = pd.Series(dtype=np.int64)
 
         self.prep_df()
+        if self.store is not None:
+            self.sync_store()
+        self.replay_journal()
+        if self.columnar:
+            review_dtypes(self.summary_df)
+        if image_dir is not None and seg_dir is not None:
+            threading.Thread(target=self.report_orphans, daemon=True).start()
         self.get_flagged_df()
 
+    def load_columnar(self, summary_path: str, columns: Iterable[str] = ()):
+        """
+        Loads the reviewer's columns from a columnar summary, with the review
+        columns taken from the review sidecar when there is one.
+        :param columns: Summary columns to load besides VIEW_COLUMNS.
+        """
+        self.csv_path = None
+        if is_columnar(summary_path):
+            self.table_path = Path(summary_path)
+        else:
+            self.csv_path = Path(summary_path)
+            self.table_path = ensure_columnar(summary_path)
+        self.review_path = review_path(self.table_path)
+
+        columns = VIEW_COLUMNS + list(columns) + list(REVIEW_COLUMNS)
+        self.summary_df = read_table(self.table_path,
+                                     list(dict.fromkeys(columns)))
+        # Merged and replayed values are plain strings until review_dtypes runs.
+        if "bp_err_reason" in self.summary_df:
+            self.summary_df["bp_err_reason"] = self.summary_df[
+                "bp_err_reason"].astype(object)
+        if self.review_path.is_file():
+            reviews = read_table(self.review_path)
+            merge_reviews(self.summary_df, reviews)
+            keys = reviews.participant_id.map(pid_key)
+            for column in reviews.columns.drop("participant_id"):
+                self.edited[column].update(keys[reviews[column].notna()])
+
+    def export_csv(self, csv_path=None):
+        """
+        Writes the full summary with the current review columns to csv.
+        Exporting to the csv a columnar copy was made from also brings the
+        copy up to date and clears the review sidecar, so the csv alone
+        holds the reviews and later changes to it, e.g. new QC flags, are
+        picked up on the next load.
+        :param csv_path: Output path, the loaded csv by default.
+        """
+        csv_path = Path(csv_path or self.csv_path
+                        or self.table_path.with_suffix(".csv"))
+        full_df = read_table(self.table_path)
+        reviews = self.flagged_df[["participant_id"] +
+                                  list(REVIEW_COLUMNS)].copy()
+        reviews.index = reviews.participant_id.map(pid_key)
+        reviews = reviews[~reviews.index.duplicated(keep="last")]
+        keys = full_df.participant_id.map(pid_key)
+        for column in REVIEW_COLUMNS:
+            full_df[column] = keys.map(
+                reviews[column].astype(object)).to_numpy()
+        review_dtypes(full_df)
+        own_csv = csv_path == self.csv_path
+        if own_csv:
+            write_table(full_df, self.table_path)
+        with atomic_path(csv_path) as tmp_path:
+            full_df.to_csv(str(tmp_path), index=False)
+        if own_csv:
+            mark_source(csv_path, self.table_path)
+            if self.review_path.is_file():
+                self.review_path.unlink()
+            self.edited.clear()
+        print(f"Exported {csv_path}")
+
+    def load_metrics(self, metrics_path):
+        """
+        Loads the precomputed geometry metrics, kept apart from the summary
+        so they are never written into the review csv.
+        """
+        self.metrics = None
+        if metrics_path is None or not Path(metrics_path).is_file():
+            return
+        metrics = pd.read_parquet(metrics_path)
+        metrics.index = metrics.participant_id.map(pid_key)
+        self.metrics = metrics[[c for c in metrics if c.startswith("geo_")]]
+        print(f"Loaded geometry metrics for {len(self.metrics)} cases")
+
+    def metrics_for(self, pid) -> Optional[pd.Series]:
+        """
+        Returns the geometry metrics of a participant, or None.
+        """
+        if self.metrics is None or pid_key(pid) not in self.metrics.index:
+            return None
+        return self.metrics.loc[pid_key(pid)]
+
+    def _flagged_changed(self):
+        """
+        Rebuilds the review queue after flagged_df was replaced or reordered.
+        Rows new to flagged_df, e.g. freshly claimed cases, are ranked after
+        the rest in the default order; known rows keep their rank, so a
+        sorted flagged_df never becomes the default order.
+        """
+        keys = self.flagged_df.participant_id.map(pid_key)
+        new = keys[~keys.isin(self._default_rank.index)].drop_duplicates()
+        if len(new):
+            start = len(self._default_rank)
+            self._default_rank = pd.concat([
+                self._default_rank,
+                pd.Series(np.arange(start, start + len(new)),
+                          index=new.to_numpy())
+            ])
+        self.set_priority(self.priority)
+
+    def set_priority(self, name: str):
+        """
+        Reorders the review queue by one of the PRIORITIES keys, after the
+        sort metric when one is set.
+        flagged_df and its row positions are left as they are.
+        """
+        self.priority = name
+        priority = PRIORITIES[name]
+        if self.sort_metric is not None:
+            # Every priority keys reviewed rows last first; the metric
+            # comes straight after, ahead of the priority's own keys.
+            metric, ascending = self.sort_metric
+            priority = (priority[:1]
+                        + [(self._metric_key(metric, ascending), not ascending)]
+                        + priority[1:])
+        self.queue = ReviewQueue(self.flagged_df, priority)
+        self.set_queue_filter(self.queue_filter, self.queue_reviewed)
+
+    def _metric_key(self, metric: str, ascending: bool):
+        """
+        Queue key callable(df) -> metric values, with cases without the
+        metric ordered last.
+        """
+        values = self.metrics[metric]
+        missing = np.inf if ascending else -np.inf
+
+        def key(df):
+            keyed = df.participant_id.map(pid_key).map(values)
+            return pd.to_numeric(keyed, errors="coerce").fillna(
+                missing).to_numpy()
+
+        return key
+
+    def set_queue_filter(self, queue_filter, reviewed: bool = True):
+        """
+        Restricts the review queue to a subset of flagged_df.
+        :param queue_filter: callable(flagged_df) -> boolean mask, or None
+            for all rows.
+        :param reviewed bool: Keep the subset's reviewed rows reachable once
+            its unreviewed rows are done.
+        """
+        self.queue_filter = queue_filter
+        self.queue_reviewed = reviewed
+        if getattr(self, "queue_view", None) is not None:
+            self.queue.close_view(self.queue_view)
+        self.queue_view = None
+        if queue_filter is not None:
+            mask = np.asarray(queue_filter(self.flagged_df), dtype=bool)
+            self.queue_view = self.queue.view(mask, reviewed)
+
+    def active_queue(self) -> ReviewQueue:
+        return self.queue_view if self.queue_view is not None else self.queue
+
+    def sort_flagged_df(self, metric: str = None, ascending: bool = False):
+        """
+        Reorders flagged_df and the review queue by a geometry metric,
+        unreviewed cases first and cases without metrics last. The metric
+        outranks the queue priority, whose keys only break ties. Without a
+        metric the order flagged_df was loaded in is restored.
+        """
+        self.sort_metric = None if metric is None else (metric, ascending)
+        keys = self.flagged_df.participant_id.map(pid_key)
+        if metric is None:
+            order = pd.DataFrame({"rank": keys.map(self._default_rank)})
+            by, ascending = ["rank"], [True]
+        else:
+            order = pd.DataFrame({
+                "reviewed": self.flagged_df.bp_reviewed.to_numpy(),
+                "metric": keys.map(self.metrics[metric]).to_numpy()
+            })
+            by, ascending = ["reviewed", "metric"], [True, ascending]
+        order = order.sort_values(by,
+                                  ascending=ascending,
+                                  na_position="last",
+                                  kind="stable")
+        self.flagged_df = self.flagged_df.iloc[order.index].reset_index(
+            drop=True)
+        self._flagged_changed()
+
+    @property
+    def image_list(self) -> list:
+        return list(self.image_index.wait().values())
+
+    @property
+    def seg_list(self) -> list:
+        return list(self.seg_index.wait().values())
+
+    def image_for(self, pid, wait: bool = True) -> Optional[str]:
+        """
+        Returns the image path for a participant, or None.
+        :param wait bool: Wait for the directory index to reach the file.
+        """
+        return self.image_index.get(pid_key(pid), wait)
+
+    def preview_for(self, pid, wait: bool = True) -> Optional[str]:
+        """
+        Returns the low resolution preview path for a participant, or None.
+        :param wait bool: Wait for the directory index to reach the file.
+        """
+        if self.preview_index is None:
+            return None
+        return self.preview_index.get(pid_key(pid), wait)
+
+    def seg_for(self, pid, wait: bool = True) -> Optional[str]:
+        """
+        Returns the segmentation path for a participant, or None.
+        :param wait bool: Wait for the directory index to reach the file.
+        """
+        return self.seg_index.get(pid_key(pid), wait)
+
+    def report_orphans(self):
+        """
+        Reports summary rows without files and files without summary rows.
+        """
+        summary_pids = set(self.summary_df.participant_id.map(pid_key))
+        image_pids = set(self.image_index.wait())
+        seg_pids = set(self.seg_index.wait())
+
+        missing_image = summary_pids - image_pids
+        missing_seg = summary_pids - seg_pids
+        orphan_files = (image_pids | seg_pids) - summary_pids
+        if missing_image:
+            print(f"{len(missing_image)} participants without an image")
+        if missing_seg:
+            print(f"{len(missing_seg)} participants without a segmentation")
+        if orphan_files:
+            print(f"{len(orphan_files)} participant ids have files but no "
+                  f"summary row")
+
     def prep_df(self):
         self.summary_df["bp_reviewed"] = self.summary_df.get("bp_reviewed", 0)
         self.summary_df["bp_err_reason"] = self.summary_df.get(
@@ -35,26 +471,300 @@ class DataLoader():
         self.summary_df["bp_subsegmental_score"] = self.summary_df.get(
             "bp_subsegmental_score", -1)
         self.summary_df["bp_inspect"] = self.summary_df.get("bp_inspect", 0)
+        self.summary_df["bp_dwell_s"] = self.summary_df.get("bp_dwell_s", 0.0)
+
+    def replay_journal(self):
+        """
+        Opens the review journal and applies changes not yet in the summary csv.
+        """
+        if self.store is not None:
+            suffix = f".{self.store.reviewer}.journal.jsonl"
+        else:
+            suffix = ".journal.jsonl"
+        self.journal = ReviewJournal(self.save_path.with_suffix(suffix))
+        keys = self.summary_df.participant_id.map(pid_key)
+        changed = defaultdict(set)
+        replayed = self.journal.replay(self.summary_df, keys, changed)
+        for column, pids in changed.items():
+            self.edited[column].update(pids)
+            # Changes a crashed session journalled but never committed.
+            self.uncommitted.update(pids)
+        if replayed:
+            print(f"Replayed {replayed} review changes from the journal")
+
+    def sync_store(self):
+        """
+        Registers the summary's cases with the shared store and applies the
+        reviews already committed there.
+        """
+        keys = self.summary_df.participant_id.map(pid_key)
+        # Claims left behind by a crashed session go back to the queue.
+        self.store.release()
+        self.store.populate(keys, self.summary_df.bp_seg_error,
+                            self.summary_df.bp_reviewed)
+        # The store's reviewer and time columns stay out of the summary.
+        reviews = self.store.reviews()
+        merge_reviews(self.summary_df,
+                      reviews[["participant_id"] + list(REVIEW_COLUMNS)])
+        first = ~keys.duplicated()
+        self._rows_by_key = pd.Series(self.summary_df.index[first],
+                                      index=keys[first])
+
+    def claim_cases(self) -> int:
+        """
+        Claims the next batch of cases from the shared store and appends
+        them to flagged_df.
+        :return: Number of cases claimed.
+        """
+        pids = [
+            pid for pid in self.store.claim_batch()
+            if pid in self._rows_by_key.index
+        ]
+        rows = self.summary_df.loc[self._rows_by_key[pids]]
+        if hasattr(self, "flagged_df"):
+            rows = pd.concat([self.flagged_df, rows])
+        self.flagged_df = rows.reset_index(drop=True)
+        self._flagged_changed()
+        return len(pids)
+
+    def commit_case(self, idx: int):
+        """
+        Commits the review of a flagged_df row to the shared store and renews
+        the lease on the remaining claims.
+        """
+        self.commit_rows([idx])
+
+    def commit_rows(self, rows):
+        """
+        Commits the reviews of flagged_df rows to the shared store in one
+        transaction and renews the lease on the remaining claims.
+        """
+        cases = []
+        for idx in rows:
+            row = self.flagged_df.loc[idx]
+            pid = pid_key(row.participant_id)
+            cases.append((pid, row[list(REVIEW_COLUMNS)].to_dict()))
+            self.uncommitted.discard(pid)
+        self.store.commit_cases(cases)
+        self.store.renew()
+
+    def renew_claims(self, keep=None) -> int:
+        """
+        Renews the lease on this reviewer's claims and drops the unreviewed
+        cases whose claim expired and was taken by another reviewer.
+        :param keep: Participant ID kept regardless, usually the case shown.
+        :return: Number of cases dropped from flagged_df.
+        """
+        held = set(self.store.renew())
+        keys = self.flagged_df.participant_id.map(pid_key)
+        lost = (self.flagged_df.bp_reviewed != 1) & ~keys.isin(held)
+        if keep is not None:
+            lost &= keys != pid_key(keep)
+        if not lost.any():
+            return 0
+        self.flagged_df = self.flagged_df[~lost].reset_index(drop=True)
+        self._flagged_changed()
+        return int(lost.sum())
+
+    def set_value(self, idx: int, column: str, value):
+        """
+        Sets a review column of a flagged_df row and journals the change.
+        """
+        if idx < 0 or self.flagged_df.at[idx, column] == value:
+            return
+        values = self.flagged_df[column]
+        if (hasattr(values, "cat")
+                and value not in values.cat.categories):
+            self.flagged_df[column] = values.cat.add_categories([value])
+        self.flagged_df.at[idx, column] = value
+        if column in self.queue.columns:
+            self.queue.update(idx)
+        pid = pid_key(self.flagged_df.at[idx, "participant_id"])
+        self.edited[column].add(pid)
+        self.uncommitted.add(pid)
+        self.journal.record(pid, column, value)
+
+    def set_values(self, rows, column: str, values) -> int:
+        """
+        Sets a review column of many flagged_df rows at once and journals the
+        changes, rebuilding the review queue once instead of per row.
+        :param rows: flagged_df row positions.
+        :param values: One value for all rows, or one per row.
+        :return: Number of values changed.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        values = np.asarray(values)
+        if values.ndim == 0:
+            values = np.full(len(rows), values.item(), dtype=values.dtype)
+        current = self.flagged_df[column]
+        if pd.api.types.is_integer_dtype(current.dtype):
+            values = values.astype(current.dtype)
+        changed = current.to_numpy()[rows] != values
+        rows, values = rows[changed], values[changed]
+        if len(rows) == 0:
+            return 0
+        if hasattr(current, "cat"):
+            new = set(values.tolist()) - set(current.cat.categories)
+            if new:
+                self.flagged_df[column] = current.cat.add_categories(
+                    sorted(new))
+        self.flagged_df.loc[rows, column] = values
+        pids = [
+            pid_key(pid)
+            for pid in self.flagged_df.participant_id.to_numpy()[rows]
+        ]
+        self.edited[column].update(pids)
+        self.uncommitted.update(pids)
+        self.journal.record_many(pids, column, values)
+        if column in self.queue.columns:
+            self.set_priority(self.priority)
+        return len(rows)
 
     def get_flagged_df(self):
         """
         Filters the summary by the bp_seg_error flag.
+        With a shared store, flagged_df holds the cases claimed by this reviewer.
         """
+        if self.store is not None:
+            claimed = self.claim_cases()
+            print(f"Claimed {claimed} scans to review...")
+            return
         self.flagged_df = self.summary_df.sort_values(by=["bp_reviewed", "bp_seg_error"],
                                                       ascending=[True, False])
         self.flagged_df.reset_index(drop=True, inplace=True)
+        self._flagged_changed()
         print(
             f"{len(self.flagged_df[(self.flagged_df.bp_seg_error == 1) & (self.flagged_df.bp_reviewed == 0)])} scans to review..."
         )
         print(f"Total scans: {len(self.flagged_df)}")
         print(f"Next scans: {self.flagged_df.bp_seg_error.head(20)}")
 
-    def get_random_sample(self, number: int = 100):
+    def get_random_sample(self,
+                          number: int = 100,
+                          seed: int = None,
+                          strata: str = None,
+                          exclude_reviewed: bool = True,
+                          manifest_path: str = None) -> list:
+        """
+        Draws a reproducible, optionally stratified sample of flagged_df.
+        :param number int: Sample size.
+        :param seed int: Random seed, drawn and recorded when not given.
+        :param strata str: Column or quantile stratum, see sampling.strata_codes.
+        :param exclude_reviewed bool: Only sample unreviewed cases.
+        :param manifest_path str: Where to save the sample manifest.
+        :return: Sampled participant IDs.
+        """
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy % 2**32)
+        # Drawn over participant ID order, which reviewing and sorting
+        # flagged_df leave alone, so a seed always picks the same cases.
+        keys = self.flagged_df.participant_id.map(pid_key).to_numpy()
+        canonical = self.flagged_df.iloc[np.argsort(keys, kind="stable")]
+        rows = draw_sample(canonical, number, seed, strata, exclude_reviewed)
+        pids = canonical.participant_id.to_numpy()[rows].tolist()
+        if manifest_path is not None:
+            save_manifest(manifest_path,
+                          pids,
+                          summary=str(self.save_path),
+                          number=number,
+                          seed=seed,
+                          strata=strata,
+                          exclude_reviewed=exclude_reviewed)
+        print(f"Sampled {len(pids)} cases with seed {seed}")
+        return pids
+
+    def sample_filter(self, pids):
+        """
+        Queue filter selecting the rows of the given participants.
+        """
+        keys = {pid_key(pid) for pid in pids}
+        return lambda df: df.participant_id.map(pid_key).isin(keys)
+
+    def sites(self) -> list:
+        """
+        Sites in flagged_df, or an empty list without a site column.
+        """
+        if "site" not in self.flagged_df:
+            return []
+        return sorted(self.flagged_df.site.dropna().astype(str).unique())
+
+    def site_filter(self, site: str):
+        """
+        Queue filter selecting the rows of one site.
+        """
+        return lambda df: df.site.astype(str) == site
+
+    def save_flagged_df(self, background: bool = False):
         """
-        Returns n random segmentations
+        Compacts the journal into the summary csv.
+        The csv is written to a temporary file and renamed over the original.
+        :param background bool: Write the csv on a background thread.
         """
-        self.random_df = self.summary_df.sample(number)
-        self.random_df.reset_index(drop=True, inplace=True)
+        if self._save_thread is not None:
+            self._save_thread.join()
+        if self.store is not None:
+            # Reviews live in the store; the shared summary is never rewritten.
+            # Only reviewed cases changed since their last commit are sent.
+            keys = self.flagged_df.participant_id.map(pid_key)
+            rows = self.flagged_df.index[(self.flagged_df.bp_reviewed == 1)
+                                         & keys.isin(self.uncommitted)]
+            self.commit_rows(rows)
+            self.journal.rotate()
+            self.journal.discard_rotated()
+            return
+        if self.columnar:
+            snapshot = self.edited_reviews()
+        else:
+            snapshot = self.flagged_df.copy()
+        self.journal.rotate()
 
-    def save_flagged_df(self):
-        self.flagged_df.to_csv(str(self.save_path), index=False)
+        def _write():
+            started = time.perf_counter()
+            if self.columnar:
+                write_table(snapshot, self.review_path)
+            else:
+                with atomic_path(self.save_path) as tmp_path:
+                    snapshot.to_csv(str(tmp_path), index=False)
+            self.journal.discard_rotated()
+            if self.telemetry is not None:
+                self.telemetry.record("save", time.perf_counter() - started,
+                                      started)
+
+        if background:
+            self._save_thread = threading.Thread(target=_write, daemon=False)
+            self._save_thread.start()
+        else:
+            self._save_thread = None
+            _write()
+
+    def edited_reviews(self) -> pd.DataFrame:
+        """
+        participant_id plus the review columns of the cases a reviewer
+        changed, with cells not changed left empty so they never override
+        the summary, e.g. bp_seg_error flags from a later QC run.
+        """
+        keys = self.flagged_df.participant_id.map(pid_key)
+        rows = keys.isin(set().union(*self.edited.values())).to_numpy()
+        reviews = self.flagged_df.loc[rows, ["participant_id"] +
+                                      list(REVIEW_COLUMNS)].copy()
+        for column in REVIEW_COLUMNS:
+            changed = keys[rows].isin(self.edited.get(column, ()))
+            reviews[column] = reviews[column].astype(object).where(
+                changed.to_numpy(), None)
+        return reviews
+
+    def close(self):
+        """
+        Compacts the journal and waits for any pending save.
+        A columnar session loaded from csv also exports the csv back, unless
+        the reviews live in a shared store.
+        """
+        self.save_flagged_df()
+        # flagged_df only holds this reviewer's claims in store mode; an
+        # export would blank every other row's review columns.
+        if (self.columnar and self.csv_path is not None
+                and self.store is None):
+            self.export_csv()
+        if self.store is not None:
+            self.store.close()
+        self.journal.close()
@@ -11,7 +11,7 @@ class SelectPathsDialog(QWidget):
         # Create buttons to select the paths
         self.images_button = QPushButton("Select Images Folder")
         self.segmentations_button = QPushButton("Select Segmentations Folder")
-        self.csv_button = QPushButton("Select CSV File")
+        self.csv_button = QPushButton("Select Summary File")
         self.confirm_button = QPushButton("Confirm and Exit")
 
         # Create labels to display the selected paths
@@ -66,9 +66,9 @@ class SelectPathsDialog(QWidget):
         options |= QFileDialog.ReadOnly
         file, _ = QFileDialog.getOpenFileName(
             self,
-            "Select CSV File",
+            "Select Summary File",
             "",
-            "CSV Files (*.csv);;All Files (*)",
+            "Summary Files (*.csv *.parquet *.feather);;All Files (*)",
             options=options)
         if file:
             # Save the selected file to a class variable
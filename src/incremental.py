@@ -0,0 +1,84 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.atomic import atomic_path
+from src.dataloader import parse_pid
+
+# Columns identifying the file each table row was computed from.
+SIGNATURE_COLUMNS = ["participant_id", "path", "size", "mtime"]
+
+
+def index_files(directory: str) -> dict:
+    """
+    Builds a participant ID -> (path, size, mtime) index in one directory pass.
+    Paths are resolved, so tables match however the directory is given.
+    Duplicates keep the first file name in sorted order.
+    """
+    index = {}
+    with os.scandir(Path(directory).resolve()) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if not entry.is_file():
+                continue
+            pid = parse_pid(entry.name)
+            if pid is None or pid in index:
+                continue
+            stat = entry.stat()
+            index[pid] = (entry.path, stat.st_size, stat.st_mtime_ns)
+    return index
+
+
+def update_table(files: dict, table_path, compute, workers: int,
+                 chunksize: int = 1, prepare=None) -> tuple:
+    """
+    Refreshes a per-participant parquet table, running compute in a process
+    pool only on files that are new or changed since the table was written.
+    Rows of files that are gone are dropped.
+    :param files: index_files() output.
+    :param compute: Picklable callable(path) -> dict of column values, or None
+        to leave the participant out, so it is tried again on the next run.
+    :param chunksize int: Files sent to a worker at a time.
+    :param prepare: Optional callable(table) -> table applied before the
+        table is written, e.g. to fill and cast columns.
+    :return: (table sorted by participant_id, number of files computed)
+    """
+    table_path = Path(table_path)
+    cached = pd.read_parquet(table_path) if table_path.is_file() else \
+        pd.DataFrame(columns=SIGNATURE_COLUMNS)
+    unchanged = [
+        files.get(pid) == (path, size, mtime)
+        for pid, path, size, mtime in cached[SIGNATURE_COLUMNS].itertuples(
+            index=False)
+    ]
+    cached = cached[np.array(unchanged, dtype=bool)]
+    done = set(cached.participant_id)
+    todo = [pid for pid in files if pid not in done]
+
+    rows = []
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(compute, [files[pid][0] for pid in todo],
+                               chunksize=chunksize)
+            for pid, values in zip(todo, results):
+                if values is None:
+                    continue
+                path, size, mtime = files[pid]
+                rows.append({
+                    "participant_id": pid,
+                    "path": path,
+                    "size": size,
+                    "mtime": mtime,
+                    **values
+                })
+
+    table = pd.concat([cached, pd.DataFrame(rows)], ignore_index=True)
+    table = table.sort_values("participant_id").reset_index(drop=True)
+    if prepare is not None:
+        table = prepare(table)
+    if rows or len(cached) != len(unchanged) or not table_path.is_file():
+        with atomic_path(table_path) as tmp_path:
+            table.to_parquet(tmp_path, index=False)
+    return table, len(todo)
@@ -0,0 +1,113 @@
+import json
+import os
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class ReviewJournal():
+
+    def __init__(self, path: str, fsync: bool = False):
+        """
+        Append-only JSON-lines log of review changes.
+        Every change is one line; the summary csv is only rewritten on compaction.
+        :param path str: Journal file path.
+        :param fsync bool: Force each change to disk, not just to the OS.
+        """
+        self.path = Path(path)
+        self.rotated_path = self.path.with_name(self.path.name + ".old")
+        self.fsync = fsync
+        self.records = 0
+        self._file = open(self.path, "a")
+
+    def record(self, pid, column: str, value):
+        """
+        Appends one review change.
+        :param pid: Participant ID key, as replay matches it.
+        """
+        self.record_many([pid], column, [value])
+
+    def record_many(self, pids, column: str, values):
+        """
+        Appends changes of one column for many participants in a single write.
+        """
+        now = time.time()
+        lines = []
+        for pid, value in zip(pids, values):
+            if isinstance(value, np.generic):
+                value = value.item()
+            if isinstance(value, float) and np.isnan(value):
+                value = None
+            lines.append(
+                json.dumps({
+                    "pid": str(pid),
+                    "column": column,
+                    "value": value,
+                    "time": now
+                }) + "\n")
+        self._file.write("".join(lines))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.records += len(lines)
+
+    def replay(self, df: pd.DataFrame, keys: pd.Series,
+               edited: dict = None) -> int:
+        """
+        Applies the latest journalled value of every (participant, column) to df.
+        :param df: Summary dataframe, modified in place.
+        :param keys: Participant ID keys aligned with df.
+        :param edited: Optional dict of column -> set, gaining the keys replayed.
+        :return: Number of values applied.
+        """
+        latest = {}
+        for path in (self.rotated_path, self.path):
+            if not path.is_file():
+                continue
+            with open(path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of a crashed session.
+                        continue
+                    latest[(rec["pid"], rec["column"])] = rec["value"]
+
+        by_column = defaultdict(dict)
+        for (pid, column), value in latest.items():
+            by_column[column][pid] = value
+            if edited is not None:
+                edited[column].add(pid)
+        for column, values in by_column.items():
+            mask = keys.isin(values)
+            df.loc[mask, column] = keys[mask].map(values)
+        return len(latest)
+
+    def rotate(self) -> Path:
+        """
+        Moves the current journal aside ahead of a compaction and starts a new one.
+        Entries left by an earlier, unfinished compaction are kept.
+        """
+        self._file.close()
+        if self.rotated_path.is_file():
+            with open(self.rotated_path, "a") as rotated, open(self.path) as f:
+                rotated.write(f.read())
+            self.path.unlink()
+        else:
+            os.replace(self.path, self.rotated_path)
+        self._file = open(self.path, "a")
+        self.records = 0
+        return self.rotated_path
+
+    def discard_rotated(self):
+        """
+        Drops the rotated journal once its changes are in the compacted csv.
+        """
+        if self.rotated_path.is_file():
+            self.rotated_path.unlink()
+
+    def close(self):
+        self._file.close()
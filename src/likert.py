@@ -1,9 +1,11 @@
 from PyQt5.QtWidgets import (QVBoxLayout, QHBoxLayout, QLabel, QRadioButton,
                              QWidget)
+from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtGui import QFont
 
 
 class LikertScale(QWidget):
+    scoreChanged = pyqtSignal(int)
 
     def __init__(self,
                  parent,
@@ -57,3 +59,4 @@ class LikertScale(QWidget):
     def on_selection(self, checked, value):
         if checked:
             self.score = value
+            self.scoreChanged.emit(value)
@@ -0,0 +1,214 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+from PyQt5 import QtCore
+
+from src.atomic import atomic_path
+from src.crop import bounding_box, load_cropped
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "segsure" / "meshes"
+
+_mlab = None
+
+
+def get_mlab():
+    """
+    Imports mayavi's mlab on first use; it takes seconds to load.
+    """
+    global _mlab
+    if _mlab is None:
+        from mayavi import mlab
+        _mlab = mlab
+    return _mlab
+
+
+def load_mask(seg_path: str) -> np.ndarray:
+    """
+    Loads a segmentation as a boolean mask without the float64 copy of get_fdata().
+    """
+    import nibabel as nib
+    return np.asanyarray(nib.load(seg_path).dataobj) > 0
+
+
+def build_mesh(mask: np.ndarray, step_size: int = 1, downsample: int = 1,
+               progress=None, offset=(0, 0, 0)):
+    """
+    Crops a mask to its bounding box and meshes it with marching cubes.
+    :param mask: 3D boolean mask.
+    :param step_size int: Marching cubes step size.
+    :param downsample int: Take every n-th voxel along each axis before meshing.
+    :param progress: Optional callable(percent, message).
+    :param offset: Position of mask in the full volume, when it is a crop.
+    :return: verts (float32, voxel coordinates of the full volume), faces (int32).
+    """
+    from skimage.measure import marching_cubes
+
+    def _report(percent, message):
+        if progress is not None:
+            progress(percent, message)
+
+    _report(30, "Cropping")
+    box = bounding_box(mask)
+    if box is None:
+        return np.empty((0, 3), np.float32), np.empty((0, 3), np.int32)
+    cropped = mask[tuple(slice(s.start, s.stop, downsample) for s in box)]
+    # Pad by one voxel so the surface closes at the crop boundary.
+    cropped = np.pad(cropped.astype(np.float32), 1)
+
+    _report(50, "Marching cubes")
+    verts, faces, _, _ = marching_cubes(cropped, 0.5, step_size=step_size)
+    origin = np.array([s.start for s in box], dtype=np.float32)
+    origin += np.asarray(offset, dtype=np.float32)
+    verts = (verts.astype(np.float32) - 1) * downsample + origin
+    return verts, faces.astype(np.int32)
+
+
+def decimate(verts: np.ndarray, faces: np.ndarray, budget: int):
+    """
+    Reduces a mesh to at most budget triangles by vertex clustering.
+    Vertices are merged on a grid that grows until the mesh fits; collapsed
+    and duplicate triangles are dropped.
+    :param budget int: Maximum number of triangles.
+    :return: verts, faces
+    """
+    cell = 1.0
+    while len(faces) > budget:
+        # Surface triangle counts fall with the square of the cell size.
+        cell *= max(np.sqrt(len(faces) / budget), 1.1)
+        _, inverse, counts = np.unique(np.floor(verts / cell).astype(np.int64),
+                                       axis=0,
+                                       return_inverse=True,
+                                       return_counts=True)
+        inverse = inverse.ravel()
+        merged = np.zeros((len(counts), 3), dtype=np.float64)
+        np.add.at(merged, inverse, verts)
+        merged /= counts[:, None]
+
+        new_faces = inverse[faces]
+        keep = ((new_faces[:, 0] != new_faces[:, 1])
+                & (new_faces[:, 1] != new_faces[:, 2])
+                & (new_faces[:, 0] != new_faces[:, 2]))
+        new_faces = new_faces[keep]
+        _, first = np.unique(np.sort(new_faces, axis=1),
+                             axis=0,
+                             return_index=True)
+        new_faces = new_faces[np.sort(first)]
+
+        used, remap = np.unique(new_faces, return_inverse=True)
+        verts = merged[used].astype(np.float32)
+        faces = remap.reshape(-1, 3).astype(np.int32)
+    return verts, faces
+
+
+def cache_path(seg_path: str, step_size: int, downsample: int,
+               cache_dir=DEFAULT_CACHE_DIR, budget: int = None) -> Path:
+    """
+    Mesh cache file for a segmentation, keyed by path, mtime and mesh settings.
+    """
+    stat = os.stat(seg_path)
+    key = (f"{os.path.abspath(seg_path)}:{stat.st_mtime_ns}:{stat.st_size}:"
+           f"{step_size}:{downsample}:{budget}")
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return Path(cache_dir) / f"{digest}.npz"
+
+
+def load_cached_mesh(path: Path):
+    if not path.is_file():
+        return None
+    try:
+        with np.load(path) as cached:
+            return cached["verts"], cached["faces"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Ignoring unreadable mesh cache {path}\n{e}")
+        return None
+
+
+def save_cached_mesh(path: Path, verts: np.ndarray, faces: np.ndarray):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_path(path) as tmp_path:
+        np.savez_compressed(tmp_path, verts=verts, faces=faces)
+
+
+class MeshWorker(QtCore.QThread):
+    progress = QtCore.pyqtSignal(int, str)
+    meshReady = QtCore.pyqtSignal(str, object, object, str)
+    failed = QtCore.pyqtSignal(str, str)
+
+    def __init__(self, parent, pid, seg_path: str, step_size: int = 1,
+                 downsample: int = 1, cache_dir=DEFAULT_CACHE_DIR,
+                 coarse_downsample: int = 4, budget: int = 200000,
+                 refine: bool = True, telemetry=None):
+        """
+        Builds (or loads from cache) the meshes of one segmentation off the
+        GUI thread: a coarse mesh first, then optionally a refined mesh
+        decimated to a triangle budget.
+        :param pid: Participant ID, passed back with the result.
+        :param seg_path str: Nifti segmentation path.
+        :param step_size int: Marching cubes step size of the refined mesh.
+        :param downsample int: Volume downsampling factor of the refined mesh.
+        :param cache_dir: Directory for cached .npz meshes.
+        :param coarse_downsample int: Volume downsampling factor of the coarse mesh.
+        :param budget int: Triangle budget of the refined mesh.
+        :param refine bool: Build the refined mesh after the coarse one.
+        :param telemetry: Optional Telemetry timing each mesh level.
+        """
+        super(MeshWorker, self).__init__(parent)
+        self.pid = str(pid)
+        self.seg_path = seg_path
+        self.step_size = step_size
+        self.downsample = downsample
+        self.cache_dir = cache_dir
+        self.coarse_downsample = coarse_downsample
+        self.budget = budget
+        self.refine = refine
+        self.telemetry = telemetry
+        self._mask = None
+        self._offset = (0, 0, 0)
+
+    def _mesh(self, level, step_size, downsample, budget, start, end):
+        started = time.perf_counter()
+
+        def _progress(percent, message):
+            self.progress.emit(start + percent * (end - start) // 100,
+                               f"{level} {message}")
+
+        cached = cache_path(self.seg_path, step_size, downsample,
+                            self.cache_dir, budget)
+        mesh = load_cached_mesh(cached)
+        if mesh is None:
+            if self._mask is None:
+                _progress(0, "loading segmentation")
+                # Only the bounding box is kept, meshed at its offset.
+                data, box = load_cropped(self.seg_path)
+                self._mask = data > 0
+                if box is not None:
+                    self._offset = tuple(s.start for s in box)
+            mesh = build_mesh(self._mask, step_size, downsample, _progress,
+                              self._offset)
+            if budget is not None and len(mesh[1]) > budget:
+                _progress(80, f"decimating {len(mesh[1])} triangles")
+                mesh = decimate(*mesh, budget)
+            _progress(90, "caching")
+            save_cached_mesh(cached, *mesh)
+        elapsed = time.perf_counter() - started
+        print(f"{self.pid} {level} mesh: {len(mesh[1])} triangles in "
+              f"{elapsed:.1f}s")
+        if self.telemetry is not None:
+            self.telemetry.record(f"mesh_{level}", elapsed, started)
+        self.meshReady.emit(self.pid, mesh[0], mesh[1], level)
+
+    def run(self):
+        try:
+            end = 30 if self.refine else 100
+            self._mesh("coarse", 1, self.coarse_downsample, None, 0, end)
+            if self.refine and not self.isInterruptionRequested():
+                self._mesh("refined", self.step_size, self.downsample,
+                           self.budget, 30, 100)
+            self.progress.emit(100, "Done")
+        except Exception as e:
+            self.failed.emit(self.pid, str(e))
+        finally:
+            self._mask = None
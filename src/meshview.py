@@ -0,0 +1,75 @@
+import os
+
+from PyQt5.QtWidgets import QLabel, QVBoxLayout, QWidget
+
+from src.meshing import get_mlab
+
+
+class MeshViewer(QWidget):
+
+    def __init__(self, parent):
+        """
+        Persistent embedded mayavi scene. The scene is built on first use, and
+        later meshes are swapped into the same surface instead of opening a
+        new window per case.
+        """
+        super(MeshViewer, self).__init__(parent)
+        self.scene = None
+        self.surface = None
+        self.pid = None
+        self._layout = QVBoxLayout(self)
+        self.status = QLabel("Press View Seg to build the 3D mesh", self)
+        self._layout.addWidget(self.status)
+
+    def _build_scene(self):
+        # traits picks its GUI toolkit at import time.
+        os.environ.setdefault("ETS_TOOLKIT", "qt4")
+        os.environ.setdefault("QT_API", "pyqt5")
+        from traits.api import HasTraits, Instance
+        from traitsui.api import Item, View
+        from mayavi.core.ui.api import MayaviScene, MlabSceneModel, SceneEditor
+
+        class _SceneModel(HasTraits):
+            scene = Instance(MlabSceneModel, ())
+            view = View(Item("scene",
+                             editor=SceneEditor(scene_class=MayaviScene),
+                             show_label=False),
+                        resizable=True)
+
+        self.scene = _SceneModel()
+        control = self.scene.edit_traits(parent=self, kind="subpanel").control
+        self._layout.addWidget(control)
+
+    def setMesh(self, pid, verts, faces):
+        """
+        Shows a mesh, reusing the existing surface and its render buffers.
+        """
+        if self.scene is None:
+            self._build_scene()
+        new_case = pid != self.pid
+        self.pid = pid
+        if self.surface is None:
+            self.surface = get_mlab().triangular_mesh(
+                verts[:, 0],
+                verts[:, 1],
+                verts[:, 2],
+                faces,
+                figure=self.scene.scene.mayavi_scene)
+        else:
+            self.surface.mlab_source.reset(x=verts[:, 0],
+                                           y=verts[:, 1],
+                                           z=verts[:, 2],
+                                           triangles=faces)
+            self.surface.visible = True
+        if new_case:
+            self.scene.scene.reset_zoom()
+        self.status.setText(f"{pid}: {len(faces)} triangles")
+
+    def clear(self, message: str = ""):
+        """
+        Hides the current mesh, keeping the scene for the next case.
+        """
+        self.pid = None
+        if self.surface is not None:
+            self.surface.visible = False
+        self.status.setText(message)
@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+
+from PyQt5 import QtCore, QtGui
+
+
+class _DecodeTask(QtCore.QRunnable):
+
+    def __init__(self, prefetcher, path: str):
+        super(_DecodeTask, self).__init__()
+        self.prefetcher = prefetcher
+        self.path = path
+
+    def run(self):
+        # QImage (unlike QPixmap) is safe to decode off the GUI thread.
+        image = self.prefetcher._decode(self.path, "decode_prefetch")
+        self.prefetcher._store(self.path, image)
+
+
+class ImagePrefetcher(QtCore.QObject):
+
+    def __init__(self,
+                 parent=None,
+                 depth: int = 3,
+                 max_bytes: int = 512 * 1024 * 1024,
+                 threads: int = 2,
+                 telemetry=None):
+        """
+        Decodes review images ahead of time into a bounded LRU cache.
+        :param parent: Owning QObject.
+        :param depth int: Number of cases to prefetch either side of the current one.
+        :param max_bytes int: Memory budget for decoded images.
+        :param threads int: Number of decoding threads.
+        :param telemetry: Optional Telemetry timing image decodes.
+        """
+        super(ImagePrefetcher, self).__init__(parent)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.telemetry = telemetry
+
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = QtCore.QThreadPool(self)
+        self._pool.setMaxThreadCount(threads)
+
+    def get(self, path: str) -> QtGui.QImage:
+        """
+        Returns the decoded image, decoding it now on a cache miss.
+        """
+        with self._lock:
+            image = self._cache.get(path)
+            if image is not None:
+                self._cache.move_to_end(path)
+                self.hits += 1
+                return image
+            self.misses += 1
+        image = self._decode(path, "decode")
+        self._store(path, image)
+        return image
+
+    def _decode(self, path: str, stage: str) -> QtGui.QImage:
+        if self.telemetry is None:
+            return QtGui.QImage(path)
+        with self.telemetry.timer(stage):
+            return QtGui.QImage(path)
+
+    def prefetch(self, paths):
+        """
+        Queues background decoding of the given paths, nearest first.
+        """
+        for path in paths:
+            if path is None:
+                continue
+            with self._lock:
+                if path in self._cache or path in self._pending:
+                    continue
+                self._pending.add(path)
+            self._pool.start(_DecodeTask(self, path))
+
+    def _store(self, path: str, image: QtGui.QImage):
+        with self._lock:
+            self._pending.discard(path)
+            if image.isNull() or path in self._cache:
+                return
+            size = image.sizeInBytes()
+            if size > self.max_bytes:
+                return
+            self._cache[path] = image
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, old = self._cache.popitem(last=False)
+                self._bytes -= old.sizeInBytes()
+
+    def clear(self):
+        self._pool.clear()
+        with self._lock:
+            self._cache.clear()
+            self._pending.clear()
+            self._bytes = 0
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0.0
+        return (f"Image cache: {self.hits} hits, {self.misses} misses "
+                f"({rate:.0f}% hit rate), {len(self._cache)} images, "
+                f"{self._bytes / 2**20:.0f}/{self.max_bytes / 2**20:.0f} MB")
@@ -0,0 +1,119 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_RULES = Path(__file__).resolve().parent.parent / "qc_rules.yaml"
+
+SEVERITIES = ("error", "warning")
+
+
+class QCRule():
+
+    def __init__(self, name: str, column: str, min=None, max=None,
+                 severity: str = "error"):
+        """
+        Range check on one summary column.
+        :param name str: Rule name, used in reports.
+        :param column str: Summary column to check.
+        :param min: Lowest passing value, or None.
+        :param max: Highest passing value, or None.
+        :param severity str: "error" rules set bp_seg_error, "warning" rules only the reason bit.
+        """
+        if severity not in SEVERITIES:
+            raise ValueError(f"Unknown severity {severity} for rule {name}")
+        self.name = name
+        self.column = column
+        self.min = min
+        self.max = max
+        self.severity = severity
+
+    def fails(self, values):
+        """
+        Works on scalars and arrays alike; missing values pass, as before.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        failed = np.zeros(values.shape, dtype=bool)
+        if self.min is not None:
+            failed |= values < self.min
+        if self.max is not None:
+            failed |= values > self.max
+        return failed
+
+
+class QCRules():
+
+    def __init__(self, rules: list):
+        if len(rules) > 64:
+            raise ValueError("At most 64 QC rules fit in the reason bitmask")
+        self.rules = rules
+
+    @property
+    def columns(self) -> list:
+        """
+        Summary columns the rules check, in rule order.
+        """
+        return list(dict.fromkeys(rule.column for rule in self.rules))
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_RULES):
+        """
+        Loads rules from a YAML file with a top level "rules" list.
+        """
+        import yaml
+        with open(path) as f:
+            config = yaml.safe_load(f)
+        return cls([QCRule(**rule) for rule in config["rules"]])
+
+    def reasons(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Evaluates every rule over the whole dataframe.
+        :return: uint64 bitmask per row, bit i set when rule i failed.
+        """
+        mask = np.zeros(len(df), dtype=np.uint64)
+        for bit, rule in enumerate(self.rules):
+            values = pd.to_numeric(df[rule.column], errors="coerce")
+            failed = rule.fails(values.to_numpy())
+            mask |= failed.astype(np.uint64) << np.uint64(bit)
+        return mask
+
+    def flag(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Sets bp_seg_error and the bp_qc_reasons bitmask in place.
+        """
+        reasons = self.reasons(df)
+        errors = np.uint64(0)
+        for bit, rule in enumerate(self.rules):
+            if rule.severity == "error":
+                errors |= np.uint64(1) << np.uint64(bit)
+        df["bp_seg_error"] = ((reasons & errors) != 0).astype(np.int64)
+        df["bp_qc_reasons"] = reasons
+        return df
+
+    def counts(self, reasons: np.ndarray) -> dict:
+        """
+        Number of rows failing each rule.
+        """
+        reasons = np.asarray(reasons, dtype=np.uint64)
+        return {
+            rule.name: int(((reasons >> np.uint64(bit)) & np.uint64(1)).sum())
+            for bit, rule in enumerate(self.rules)
+        }
+
+    def names(self, reasons) -> list:
+        """
+        Names of the rules set in one bitmask.
+        """
+        reasons = int(reasons)
+        return [
+            rule.name for bit, rule in enumerate(self.rules)
+            if reasons >> bit & 1
+        ]
+
+    def fails(self, column: str, value) -> bool:
+        """
+        Whether a single value of a column fails any rule on that column.
+        """
+        return any(
+            bool(rule.fails(value)) for rule in self.rules
+            if rule.column == column)
@@ -0,0 +1,188 @@
+import heapq
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+def qc_reason_count(df: pd.DataFrame) -> np.ndarray:
+    """
+    Number of failed QC rules per row, from the bp_qc_reasons bitmask.
+    """
+    if "bp_qc_reasons" not in df:
+        return np.zeros(len(df))
+    reasons = pd.to_numeric(df.bp_qc_reasons, errors="coerce").fillna(0)
+    reasons = reasons.to_numpy().astype(np.uint64)
+    count = np.zeros(len(df))
+    for bit in range(64):
+        count += (reasons >> np.uint64(bit)) & np.uint64(1)
+    return count
+
+
+# Priority keys: (column name or callable(df) -> values, descending) pairs,
+# compared in order. Ties keep flagged_df order.
+PRIORITIES = {
+    "Flagged first": [("bp_reviewed", False), ("bp_seg_error", True)],
+    "Inspect first": [("bp_reviewed", False), ("bp_inspect", True),
+                      ("bp_seg_error", True)],
+    "QC severity": [("bp_reviewed", False), ("bp_seg_error", True),
+                    (qc_reason_count, True)],
+    "List order": [("bp_reviewed", False)],
+}
+
+
+class ReviewQueue():
+
+    def __init__(self, df: pd.DataFrame, priority: list = None, rows=None,
+                 reviewed: bool = True):
+        """
+        Heap of flagged_df rows ordered by pluggable priority keys.
+        Rows are never copied; changing a key column only pushes a new heap
+        entry for that row, and outdated entries are dropped when reached.
+        :param df: flagged_df, with a 0..n-1 index.
+        :param priority list: (column or callable, descending) pairs.
+        :param rows: Row positions in this queue, all rows by default.
+        :param reviewed bool: Whether walk() visits reviewed rows.
+        """
+        self.df = df
+        self.priority = priority or PRIORITIES["Flagged first"]
+        self.rows = np.arange(len(df)) if rows is None else np.asarray(rows)
+        self.reviewed = reviewed
+        self._ordered = np.sort(self.rows)
+        self.members = set(self.rows.tolist())
+        self.views = []
+        # With reviewed rows keyed last, the first reviewed row reached
+        # means no unreviewed rows are left.
+        self._reviewed_last = self.priority[0] == ("bp_reviewed", False)
+        self._version = dict.fromkeys(self.members, 0)
+
+        keys = self._keys(df, self.rows)
+        self._heap = [(tuple(k), int(row), 0)
+                      for k, row in zip(keys.tolist(), self.rows)]
+        heapq.heapify(self._heap)
+
+    def _keys(self, df: pd.DataFrame, rows: np.ndarray) -> np.ndarray:
+        columns = []
+        for key, descending in self.priority:
+            if callable(key):
+                values = np.asarray(key(df), dtype=np.float64)[rows]
+            else:
+                values = pd.to_numeric(df[key], errors="coerce").to_numpy(
+                    dtype=np.float64)[rows]
+            values = np.nan_to_num(values)
+            columns.append(-values if descending else values)
+        return np.column_stack(columns) if columns else np.zeros(
+            (len(rows), 0))
+
+    @property
+    def columns(self) -> set:
+        return {key for key, _ in self.priority if not callable(key)}
+
+    def __len__(self):
+        return len(self.members)
+
+    def update(self, idx: int):
+        """
+        Re-keys one row after one of its priority columns changed.
+        """
+        for view in self.views:
+            view.update(idx)
+        if idx not in self.members:
+            return
+        self._version[idx] += 1
+        row_df = self.df.iloc[[idx]]
+        key = self._keys(row_df, np.array([0]))[0]
+        heapq.heappush(self._heap, (tuple(key.tolist()), idx,
+                                    self._version[idx]))
+
+    def next(self, exclude: int = None, where=None,
+             unreviewed: bool = True) -> Optional[int]:
+        """
+        Highest priority row, without removing it from the queue.
+        :param exclude int: Row to skip, usually the current case.
+        :param where: Optional callable(idx) -> bool rows must satisfy.
+        :param unreviewed bool: Only return rows not yet reviewed.
+        :return: Row position, or None when no row qualifies.
+        """
+        skipped = []
+        found = None
+        while self._heap:
+            entry = self._heap[0]
+            _, idx, version = entry
+            if version != self._version[idx]:
+                heapq.heappop(self._heap)
+                continue
+            reviewed = unreviewed and self.df.at[idx, "bp_reviewed"] == 1
+            if reviewed and self._reviewed_last:
+                break
+            if (idx == exclude or reviewed
+                    or (where is not None and not where(idx))):
+                skipped.append(heapq.heappop(self._heap))
+                continue
+            found = idx
+            break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return found
+
+    def peek(self, count: int, exclude: int = None) -> list:
+        """
+        The count highest priority unreviewed rows in queue order, without
+        removing them; what repeated next() calls would return if each row
+        were reviewed in turn.
+        :param exclude int: Row to skip, usually the current case.
+        """
+        found, popped = [], []
+        while self._heap and len(found) < count:
+            entry = heapq.heappop(self._heap)
+            _, idx, version = entry
+            if version != self._version[idx]:
+                continue
+            popped.append(entry)
+            reviewed = self.df.at[idx, "bp_reviewed"] == 1
+            if reviewed and self._reviewed_last:
+                break
+            if idx != exclude and not reviewed:
+                found.append(idx)
+        for entry in popped:
+            heapq.heappush(self._heap, entry)
+        return found
+
+    def next_flagged(self, exclude: int = None) -> Optional[int]:
+        """
+        Highest priority unreviewed row with bp_seg_error set.
+        """
+        return self.next(exclude,
+                         where=lambda idx: self.df.at[idx, "bp_seg_error"] == 1)
+
+    def walk(self, idx: int, step: int = 1) -> Optional[int]:
+        """
+        The row after idx (before it with a negative step) in flagged_df
+        order among this queue's rows, wrapping around. Stands in for next()
+        once nothing is left to review, so reviewed rows stay reachable.
+        :param idx int: Current row, or -1 for none.
+        :return: Row position, or None when the queue has no row to visit.
+        """
+        rows = self._ordered
+        if not self.reviewed:
+            rows = rows[self.df.bp_reviewed.to_numpy()[rows] != 1]
+        if len(rows) == 0:
+            return None
+        if step > 0:
+            return int(rows[np.searchsorted(rows, idx, "right") % len(rows)])
+        return int(rows[(np.searchsorted(rows, idx, "left") - 1) % len(rows)])
+
+    def view(self, mask, reviewed: bool = True) -> "ReviewQueue":
+        """
+        Queue over the rows where mask is true, sharing this queue's dataframe
+        and priority. Membership is fixed when the view is made.
+        :param reviewed bool: Whether walk() visits the view's reviewed rows.
+        """
+        view = ReviewQueue(self.df, self.priority,
+                           np.flatnonzero(np.asarray(mask)), reviewed)
+        self.views.append(view)
+        return view
+
+    def close_view(self, view: "ReviewQueue"):
+        if view in self.views:
+            self.views.remove(view)
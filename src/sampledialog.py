@@ -0,0 +1,63 @@
+from PyQt5.QtWidgets import (QDialog, QDialogButtonBox, QFormLayout,
+                             QSpinBox, QComboBox, QCheckBox, QFileDialog)
+
+from src.sampling import QUANTILE_STRATA
+
+
+class SampleDialog(QDialog):
+
+    def __init__(self, parent, columns):
+        super().__init__(parent)
+        self.setWindowTitle("Draw Review Sample")
+
+        self.size_box = QSpinBox()
+        self.size_box.setRange(1, 100000)
+        self.size_box.setValue(100)
+
+        # 0 draws a fresh seed, which is recorded in the manifest.
+        self.seed_box = QSpinBox()
+        self.seed_box.setRange(0, 2**31 - 1)
+        self.seed_box.setSpecialValueText("Random")
+
+        self.strata_box = QComboBox()
+        self.strata_box.addItem("None")
+        self.strata_box.addItem("bp_seg_error")
+        if "site" in columns:
+            self.strata_box.addItem("site")
+        self.strata_box.addItems(QUANTILE_STRATA)
+
+        self.exclude_box = QCheckBox("Exclude reviewed cases")
+        self.exclude_box.setChecked(True)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok
+                                   | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        layout = QFormLayout(self)
+        layout.addRow("Cases", self.size_box)
+        layout.addRow("Seed", self.seed_box)
+        layout.addRow("Stratify by", self.strata_box)
+        layout.addRow(self.exclude_box)
+        layout.addRow(buttons)
+
+    def sample(self, revdata):
+        """
+        Draws the sample and asks where to save its manifest.
+        :return: (name, participant IDs, exclude_reviewed), or None if
+            cancelled.
+        """
+        path, _ = QFileDialog.getSaveFileName(self, "Save Sample Manifest",
+                                              "", "Sample Manifests (*.json)")
+        if not path:
+            return None
+        strata = self.strata_box.currentText()
+        exclude_reviewed = self.exclude_box.isChecked()
+        pids = revdata.get_random_sample(
+            self.size_box.value(),
+            seed=self.seed_box.value() or None,
+            strata=None if strata == "None" else strata,
+            exclude_reviewed=exclude_reviewed,
+            manifest_path=path)
+        name = path.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+        return f"Sample: {name}", pids, exclude_reviewed
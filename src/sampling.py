@@ -0,0 +1,95 @@
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Strata that bin a continuous summary column into quantiles.
+QUANTILE_STRATA = {
+    "TLV quantiles": "bp_tlv",
+    "TAV quantiles": "bp_airvol",
+    "TAC quantiles": "bp_tcount",
+}
+
+
+def strata_codes(df: pd.DataFrame, strata: str = None,
+                 quantiles: int = 4) -> np.ndarray:
+    """
+    Integer stratum per row.
+    :param strata str: A column to stratify on (e.g. bp_seg_error or a site
+        column), a QUANTILE_STRATA name, or None for a single stratum.
+    :param quantiles int: Number of bins for quantile strata.
+    """
+    if strata is None:
+        return np.zeros(len(df), dtype=np.int64)
+    if strata in QUANTILE_STRATA:
+        values = pd.to_numeric(df[QUANTILE_STRATA[strata]], errors="coerce")
+        # Missing values get their own stratum (code -1).
+        return pd.qcut(values, quantiles, labels=False,
+                       duplicates="drop").fillna(-1).to_numpy(np.int64)
+    return pd.factorize(df[strata])[0]
+
+
+def draw_sample(df: pd.DataFrame,
+                number: int,
+                seed: int = None,
+                strata: str = None,
+                exclude_reviewed: bool = True,
+                quantiles: int = 4) -> np.ndarray:
+    """
+    Draws row positions for a reproducible, proportionally stratified sample.
+    Only index arrays are built; df is never copied.
+    :param df: Summary dataframe to sample from.
+    :param number int: Sample size.
+    :param seed int: Random seed; the same seed and inputs give the same sample.
+    :param strata str: See strata_codes.
+    :param exclude_reviewed bool: Leave out rows with bp_reviewed set.
+    :param quantiles int: Number of bins for quantile strata.
+    :return: Sorted row positions.
+    """
+    rng = np.random.default_rng(seed)
+    eligible = np.arange(len(df))
+    if exclude_reviewed and "bp_reviewed" in df:
+        eligible = np.flatnonzero(df.bp_reviewed.to_numpy() != 1)
+    number = min(number, len(eligible))
+    if number == 0:
+        return eligible[:0]
+
+    codes = strata_codes(df, strata, quantiles)[eligible]
+    groups, inverse, sizes = np.unique(codes,
+                                       return_inverse=True,
+                                       return_counts=True)
+    # Proportional allocation, remainders going to the largest fractions.
+    quota = sizes * number / len(eligible)
+    counts = np.floor(quota).astype(np.int64)
+    remainder = number - counts.sum()
+    counts[np.argsort(counts - quota, kind="stable")[:remainder]] += 1
+
+    order = np.argsort(inverse, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    picked = [
+        rng.choice(order[start:start + size], count, replace=False)
+        for start, size, count in zip(starts, sizes, counts) if count
+    ]
+    return np.sort(eligible[np.concatenate(picked)])
+
+
+def save_manifest(path, pids, **settings):
+    """
+    Records a sample's participant IDs and the settings that drew it.
+    """
+    manifest = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        **settings,
+        "participant_ids": [str(pid) for pid in pids],
+    }
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_manifest(path) -> dict:
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest["name"] = Path(path).stem
+    return manifest
@@ -1,6 +1,8 @@
+import numpy as np
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtWidgets import (QGraphicsView, QGraphicsScene,
-                             QGraphicsPixmapItem, QFrame)
+                             QGraphicsPixmapItem, QFrame, QWidget, QComboBox,
+                             QSlider, QLabel, QHBoxLayout, QVBoxLayout)
 
 
 class SegmentationViewer(QGraphicsView):
@@ -12,6 +14,8 @@ class SegmentationViewer(QGraphicsView):
         self._empty = True
         self._scene = QGraphicsScene(self)
         self._photo = QGraphicsPixmapItem()
+        self._photo.setTransformationMode(QtCore.Qt.SmoothTransformation)
+        self._load_full = None
         self._scene.addItem(self._photo)
         self.setScene(self._scene)
         self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
@@ -25,7 +29,7 @@ class SegmentationViewer(QGraphicsView):
         return not self._empty
 
     def fitInView(self, scale=True):
-        rect = QtCore.QRectF(self._photo.pixmap().rect())
+        rect = self._photo.sceneBoundingRect()
         if not rect.isNull():
             self.setSceneRect(rect)
             if self.hasPhoto():
@@ -38,12 +42,27 @@ class SegmentationViewer(QGraphicsView):
                 self.scale(factor, factor)
             self._zoom = 0
 
-    def setPhoto(self, pixmap=None):
+    def setPhoto(self, pixmap=None, full_size=None, load_full=None):
+        """
+        Shows an image.
+        :param pixmap: QPixmap or QImage.
+        :param full_size: QSize of the full image when pixmap is a preview;
+            the preview is scaled up to it so the view is the same either way.
+        :param load_full: Callable returning the full QImage, called on the
+            first zoom in.
+        """
         self._zoom = 0
+        self._load_full = load_full
+        if isinstance(pixmap, QtGui.QImage):
+            pixmap = QtGui.QPixmap.fromImage(pixmap)
         if pixmap and not pixmap.isNull():
             self._empty = False
             self.setDragMode(QGraphicsView.ScrollHandDrag)
             self._photo.setPixmap(pixmap)
+            if full_size is not None and full_size.width() > 0:
+                self._photo.setScale(full_size.width() / pixmap.width())
+            else:
+                self._photo.setScale(1)
         else:
             self._empty = True
             self.setDragMode(QGraphicsView.NoDrag)
@@ -59,9 +78,112 @@ class SegmentationViewer(QGraphicsView):
                 factor = 0.8
                 self._zoom -= 1
             if self._zoom > 0:
+                self._swap_full()
                 self.scale(factor, factor)
             elif self._zoom == 0:
                 self.fitInView()
             else:
                 self._zoom = 0
 
+    def _swap_full(self):
+        # Replaces the preview with the full image at the same scene size.
+        if self._load_full is None:
+            return
+        image = self._load_full()
+        self._load_full = None
+        if image is None or image.isNull():
+            return
+        self._photo.setPixmap(QtGui.QPixmap.fromImage(image))
+        self._photo.setScale(1)
+
+
+class SliceViewer(QWidget):
+    # (label, axis, maximum intensity projection)
+    PLANES = [("Axial", 2, False), ("Coronal", 1, False),
+              ("Sagittal", 0, False), ("Axial MIP", 2, True),
+              ("Coronal MIP", 1, True), ("Sagittal MIP", 0, True)]
+
+    def __init__(self, parent):
+        """
+        Orthogonal slices and MIPs of a segmentation. Uncompressed nifti is
+        read through nibabel's memory-mapped dataobj, so only the visible
+        slice is read from disk; nothing is converted to float64.
+        """
+        super(SliceViewer, self).__init__(parent)
+        self._volume = None
+        self._path = None
+        self._mips = {}
+
+        self.view = SegmentationViewer(self)
+        self.view.viewport().installEventFilter(self)
+        self.plane_box = QComboBox(self)
+        self.plane_box.addItems([plane[0] for plane in self.PLANES])
+        self.slider = QSlider(QtCore.Qt.Horizontal, self)
+        self.slice_label = QLabel("", self)
+
+        self.plane_box.currentIndexChanged.connect(self.plane_changed)
+        self.slider.valueChanged.connect(self.render)
+
+        controls = QHBoxLayout()
+        controls.addWidget(self.plane_box)
+        controls.addWidget(self.slider)
+        controls.addWidget(self.slice_label)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.view)
+        layout.addLayout(controls)
+
+    def setVolume(self, seg_path: str):
+        if seg_path == self._path:
+            return
+        import nibabel as nib
+        self._path = seg_path
+        self._mips = {}
+        # A memmap for uncompressed nifti; compressed files can't be mapped
+        # and are read once in their native dtype.
+        self._volume = np.asanyarray(nib.load(seg_path).dataobj)
+        self.plane_changed(self.plane_box.currentIndex(), fit=True)
+
+    def plane_changed(self, index, fit=False):
+        if self._volume is None:
+            return
+        _, axis, mip = self.PLANES[index]
+        self.slider.setEnabled(not mip)
+        self.slider.blockSignals(True)
+        self.slider.setRange(0, self._volume.shape[axis] - 1)
+        self.slider.setValue(self._volume.shape[axis] // 2)
+        self.slider.blockSignals(False)
+        self.render()
+        if fit:
+            self.view.fitInView()
+
+    def render(self, *args):
+        if self._volume is None:
+            return
+        _, axis, mip = self.PLANES[self.plane_box.currentIndex()]
+        if mip:
+            if axis not in self._mips:
+                self._mips[axis] = self._volume.max(axis=axis)
+            plane = self._mips[axis]
+            self.slice_label.setText("MIP")
+        else:
+            index = [slice(None)] * 3
+            index[axis] = self.slider.value()
+            plane = self._volume[tuple(index)]
+            self.slice_label.setText(
+                f"{self.slider.value() + 1}/{self._volume.shape[axis]}")
+        plane = np.ascontiguousarray(np.rot90(plane != 0).astype(np.uint8) *
+                                     255)
+        height, width = plane.shape
+        image = QtGui.QImage(plane.data, width, height, width,
+                             QtGui.QImage.Format_Grayscale8).copy()
+        self.view.setPhoto(image)
+
+    def eventFilter(self, obj, event):
+        # The wheel scrolls through slices, Ctrl+wheel zooms.
+        if (event.type() == QtCore.QEvent.Wheel
+                and not event.modifiers() & QtCore.Qt.ControlModifier
+                and self.slider.isEnabled()):
+            step = 1 if event.angleDelta().y() > 0 else -1
+            self.slider.setValue(self.slider.value() + step)
+            return True
+        return super(SliceViewer, self).eventFilter(obj, event)
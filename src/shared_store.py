@@ -0,0 +1,175 @@
+import sqlite3
+import time
+
+import pandas as pd
+
+from src.columnar import REVIEW_COLUMNS
+
+
+class SharedReviewStore():
+
+    def __init__(self,
+                 db_path: str,
+                 reviewer: str,
+                 lease_minutes: float = 30,
+                 batch_size: int = 20,
+                 journal_mode: str = "WAL"):
+        """
+        SQLite review store shared by several reviewers of one cohort.
+        Reviewers claim batches of unreviewed cases under a lease, so no two
+        reviewers work the same case, and commit each review as it is finished.
+        WAL needs every reviewer's process on a filesystem with working shared
+        memory; on network shares use journal_mode="DELETE".
+        :param db_path str: SQLite database path.
+        :param reviewer str: Name recorded against claims and reviews.
+        :param lease_minutes float: How long a claim is held without renewal.
+        :param batch_size int: Cases claimed at a time.
+        :param journal_mode str: SQLite journal mode.
+        """
+        self.reviewer = reviewer
+        self.lease_seconds = lease_minutes * 60
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        review_cols = ", ".join(REVIEW_COLUMNS)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cases (
+                    pid TEXT PRIMARY KEY,
+                    seg_error INTEGER NOT NULL DEFAULT 0,
+                    reviewed INTEGER NOT NULL DEFAULT 0,
+                    claimed_by TEXT,
+                    lease_until REAL
+                )""")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS cases_queue
+                ON cases (reviewed, seg_error)""")
+            self.conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS reviews (
+                    pid TEXT PRIMARY KEY,
+                    {review_cols},
+                    reviewer TEXT,
+                    time REAL
+                )""")
+            # Stores made before a review column existed gain it here.
+            existing = {
+                row[1]
+                for row in self.conn.execute("PRAGMA table_info(reviews)")
+            }
+            for column in REVIEW_COLUMNS:
+                if column not in existing:
+                    self.conn.execute(
+                        f"ALTER TABLE reviews ADD COLUMN {column}")
+
+    def populate(self, keys: pd.Series, seg_error: pd.Series,
+                 reviewed: pd.Series):
+        """
+        Adds cases not yet in the store, in summary order.
+        """
+        rows = zip(keys, seg_error.fillna(0).astype(int),
+                   reviewed.fillna(0).astype(int))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO cases (pid, seg_error, reviewed) "
+                "VALUES (?, ?, ?)", rows)
+
+    def reviews(self) -> pd.DataFrame:
+        """
+        All committed reviews, keyed by participant_id.
+        """
+        reviews = pd.read_sql_query("SELECT * FROM reviews", self.conn)
+        return reviews.rename(columns={"pid": "participant_id"})
+
+    def claim_batch(self, size: int = None) -> list:
+        """
+        Claims the next unreviewed, unclaimed cases, flagged cases first.
+        Expired claims of other reviewers are taken over.
+        :return: Claimed participant IDs in review order.
+        """
+        now = time.time()
+        with self.conn:
+            # IMMEDIATE takes the write lock before reading, so two
+            # reviewers can never select the same cases.
+            self.conn.execute("BEGIN IMMEDIATE")
+            pids = [
+                row[0] for row in self.conn.execute(
+                    "SELECT pid FROM cases WHERE reviewed = 0 AND "
+                    "(claimed_by IS NULL OR lease_until < ?) "
+                    "ORDER BY seg_error DESC, rowid LIMIT ?",
+                    (now, size or self.batch_size))
+            ]
+            self.conn.executemany(
+                "UPDATE cases SET claimed_by = ?, lease_until = ? "
+                "WHERE pid = ?",
+                [(self.reviewer, now + self.lease_seconds, p) for p in pids])
+        return pids
+
+    def renew(self) -> list:
+        """
+        Extends the lease on all open claims of this reviewer.
+        :return: Participant IDs still claimed by this reviewer; expired
+            claims taken over by another reviewer are missing.
+        """
+        with self.conn:
+            self.conn.execute(
+                "UPDATE cases SET lease_until = ? "
+                "WHERE claimed_by = ? AND reviewed = 0",
+                (time.time() + self.lease_seconds, self.reviewer))
+            return [
+                row[0] for row in self.conn.execute(
+                    "SELECT pid FROM cases "
+                    "WHERE claimed_by = ? AND reviewed = 0",
+                    (self.reviewer, ))
+            ]
+
+    def release(self):
+        """
+        Returns unfinished claims to the queue.
+        """
+        with self.conn:
+            self.conn.execute(
+                "UPDATE cases SET claimed_by = NULL, lease_until = NULL "
+                "WHERE claimed_by = ? AND reviewed = 0", (self.reviewer, ))
+
+    def commit_case(self, pid: str, values: dict):
+        """
+        Stores the review of one case and marks it reviewed.
+        :param pid str: Participant ID key.
+        :param values dict: Review column -> value.
+        """
+        self.commit_cases([(pid, values)])
+
+    def commit_cases(self, cases):
+        """
+        Stores the reviews of several cases in one transaction.
+        :param cases: (participant ID key, dict of review column -> value) pairs.
+        """
+        now = time.time()
+        with self.conn:
+            for pid, values in cases:
+                values = {
+                    c: (v.item() if hasattr(v, "item") else v)
+                    for c, v in values.items() if c in REVIEW_COLUMNS
+                }
+                columns = ", ".join(values)
+                marks = ", ".join("?" for _ in values)
+                owner = self.conn.execute(
+                    "SELECT claimed_by FROM cases WHERE pid = ?",
+                    (pid, )).fetchone()
+                if owner and owner[0] not in (None, self.reviewer):
+                    print(f"{pid} is claimed by {owner[0]}, "
+                          f"overwriting with this review")
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO reviews "
+                    f"(pid, {columns}, reviewer, time) "
+                    f"VALUES (?, {marks}, ?, ?)",
+                    (pid, *values.values(), self.reviewer, now))
+                self.conn.execute(
+                    "UPDATE cases SET reviewed = ?, claimed_by = NULL, "
+                    "lease_until = NULL WHERE pid = ?",
+                    (int(values.get("bp_reviewed", 1)), pid))
+
+    def close(self):
+        self.release()
+        self.conn.close()
@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Telemetry():
+
+    def __init__(self, window: int = 500, trace_path: str = None):
+        """
+        Rolling latency samples per named stage, safe to record from any thread.
+        :param window int: Samples kept per stage, and cases kept for the
+            cases/hour rate.
+        :param trace_path str: Optional Chrome trace file (chrome://tracing,
+            Perfetto) every timed span is appended to.
+        """
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.cases = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._trace = None
+        if trace_path is not None:
+            # The trace format allows an unterminated array, so a crashed
+            # session still leaves a readable trace.
+            self._trace = open(trace_path, "w")
+            self._trace.write("[\n")
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Times the enclosed block as one sample of stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, start)
+
+    def record(self, stage: str, seconds: float, start: float = None):
+        """
+        Adds one latency sample.
+        :param start float: perf_counter() at the start of the span, for the trace.
+        """
+        with self._lock:
+            self.samples[stage].append(seconds)
+            if self._trace is not None:
+                if start is None:
+                    start = time.perf_counter() - seconds
+                self._trace.write(json.dumps({
+                    "name": stage,
+                    "ph": "X",
+                    "ts": round(start * 1e6),
+                    "dur": round(seconds * 1e6),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident()
+                }) + ",\n")
+
+    def case_done(self):
+        with self._lock:
+            self.cases.append(time.perf_counter())
+
+    def percentiles(self, stage: str) -> tuple:
+        """
+        :return: (samples, p50 seconds, p95 seconds) of a stage.
+        """
+        with self._lock:
+            samples = np.array(self.samples[stage])
+        if samples.size == 0:
+            return 0, float("nan"), float("nan")
+        p50, p95 = np.percentile(samples, [50, 95])
+        return samples.size, p50, p95
+
+    def cases_per_hour(self) -> float:
+        """
+        Review rate over the last window cases.
+        """
+        with self._lock:
+            if len(self.cases) < 2:
+                return 0.0
+            span = self.cases[-1] - self.cases[0]
+            return (len(self.cases) - 1) * 3600 / span if span > 0 else 0.0
+
+    def report(self) -> str:
+        lines = [f"{self.cases_per_hour():.0f} cases/hour"]
+        for stage in sorted(self.samples):
+            n, p50, p95 = self.percentiles(stage)
+            lines.append(f"{stage}: p50 {p50 * 1000:.0f} ms, "
+                         f"p95 {p95 * 1000:.0f} ms ({n})")
+        return "\n".join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
@@ -2,35 +2,131 @@
 
 from pathlib import Path
 import argparse
+import os
+import time
+
+import numpy as np
 import pandas as pd
 
+from src.atomic import atomic_path
+from src.incremental import SIGNATURE_COLUMNS, index_files, update_table
+
+LOBE_COUNTS_NAME = "lobe_counts.parquet"
+
+
+def lobe_counts(pickle_path: str) -> dict:
+    """
+    Branch count per lobe of one participant's branch dataframe pickle.
+    :return: dict of lobe -> count, or None if the pickle has no lobes column.
+    """
+    df = pd.read_pickle(pickle_path)
+    try:
+        lobes = df.lobes[df.lobes.astype(bool)].value_counts()
+    except AttributeError as e:
+        print(f"Error processing pickle {pickle_path}\n{e}")
+        return None
+    return {str(lobe): int(count) for lobe, count in lobes.items()}
+
+
+def _count(pickle_path: str) -> dict:
+    counts = lobe_counts(pickle_path)
+    return {
+        "readable": counts is not None,
+        **{f"lobe_{lobe}": n for lobe, n in (counts or {}).items()}
+    }
+
+
+def _prepare_lobe_table(table: pd.DataFrame) -> pd.DataFrame:
+    # Lobes missing from a pickle count 0, and are sorted after the file columns.
+    lobe_columns = sorted(c for c in table if c.startswith("lobe_"))
+    table[lobe_columns] = table[lobe_columns].fillna(0).astype(np.int32)
+    table["readable"] = table.get("readable", True)
+    table["readable"] = table["readable"].astype(bool)
+    return table[SIGNATURE_COLUMNS + ["readable"] + lobe_columns]
+
+
+def update_lobe_table(pickle_index: dict, table_path: Path, workers: int,
+                      chunksize: int) -> tuple:
+    """
+    Refreshes the participant x lobe branch count table, unpickling only
+    pickles that are new or changed since the table was written.
+    Columns: participant_id, path, size, mtime, readable, then one
+    lobe_<name> count column per lobe seen.
+    :return: (table, number of pickles read)
+    """
+    return update_table(pickle_index, table_path, _count, workers, chunksize,
+                        prepare=_prepare_lobe_table)
+
+
+def discontinuous(table: pd.DataFrame, min_lobes: int = 5,
+                  min_branches: int = 5) -> pd.Series:
+    """
+    Flags participants with fewer than min_lobes lobes, or a lobe with fewer
+    than min_branches branches. Unreadable pickles are not flagged.
+    :return: int8 flags indexed by participant ID.
+    """
+    counts = table[[c for c in table if c.startswith("lobe_")]].to_numpy()
+    present = counts > 0
+    too_few = present.sum(axis=1) < min_lobes
+    sparse = (present & (counts < min_branches)).any(axis=1)
+    flags = table.readable.to_numpy() & (too_few | sparse)
+    return pd.Series(flags.astype(np.int8),
+                     index=table.participant_id.to_numpy())
+
 
 def main(args):
 
-    main_dir = Path(args.pickle_dir)
-    list_pickles = [str(p) for p in main_dir.iterdir() if p.is_file()]
+    start = time.perf_counter()
+    pickle_index = index_files(args.pickle_dir)
+    table_path = Path(args.table
+                      or Path(args.pickle_dir).parent / LOBE_COUNTS_NAME)
+    table, read = update_lobe_table(pickle_index, table_path, args.workers,
+                                    args.chunksize)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"Read {read} new or changed pickles in {elapsed:.1f}s "
+          f"({read / elapsed:.0f} pickles/s), "
+          f"{len(table) - read} unchanged")
 
-    def _check_lobes(row):
-        pid = row["participant_id"]
-        pickle_search = [p for p in list_pickles if str(pid) in p]
-        pickle_path = pickle_search[0]
-        df = pd.read_pickle(str(pickle_path))
+    # Columns are read as text and written back untouched, so the streamed
+    # and in-memory outputs are byte-identical.
+    if args.stream:
+        pids = pd.read_csv(args.merged_csv,
+                           usecols=["participant_id"],
+                           dtype=str).participant_id
+        chunks = pd.read_csv(args.merged_csv,
+                             dtype=str,
+                             keep_default_na=False,
+                             chunksize=args.stream)
+    else:
+        sum_df = pd.read_csv(args.merged_csv, dtype=str, keep_default_na=False)
+        pids = sum_df.participant_id
+        chunks = [sum_df]
 
-        try:
-            lobes = df.lobes[df.lobes.astype(bool)].value_counts()
-            if (len(lobes) < 5) or (lobes < 5).any():
-                print(
-                    f"Potential gap in segmentation in {row['participant_id']}"
-                )
-                row["bp_seg_error"] = 1
-        except AttributeError as e:
-            print(f"Error processing pickle for {pid}\n{e}")
+    pids = pids.str.zfill(6)
+    for pid in pids[~pids.isin(pickle_index)]:
+        print(f"No pickle found for {pid}")
+    flags = discontinuous(table)
+    flags = flags[flags.index.isin(pids)]
 
-        return row
+    n_gaps = 0
+    with atomic_path(args.output_csv) as tmp_path:
+        for i, df in enumerate(chunks):
+            gaps = df.participant_id.str.zfill(6).map(flags).fillna(0)
+            gaps = gaps.astype(bool).to_numpy()
+            for pid in df.participant_id[gaps]:
+                print(f"Potential gap in segmentation in {pid}")
+            if "bp_seg_error" not in df:
+                df["bp_seg_error"] = ""
+            df.loc[gaps, "bp_seg_error"] = "1"
+            df.to_csv(tmp_path,
+                      mode="w" if i == 0 else "a",
+                      header=i == 0,
+                      index=False)
+            n_gaps += gaps.sum()
 
-    sum_df = pd.read_csv(args.merged_csv)
-    sum_df = sum_df.apply(_check_lobes, axis=1)
-    sum_df.to_csv("merged_summaries_final.csv", index=False)
+    elapsed = time.perf_counter() - start
+    print(f"Checked {len(flags)} participants in {elapsed:.1f}s, "
+          f"{n_gaps} potential gaps")
 
 
 if __name__ == '__main__':
@@ -41,6 +137,31 @@ if __name__ == '__main__':
     parser.add_argument("pickle_dir",
                         type=str,
                         help="Path for pickles directory.")
+    parser.add_argument("output_csv",
+                        type=str,
+                        nargs="?",
+                        default="merged_summaries_final.csv",
+                        help="Path for the flagged summary.")
+    parser.add_argument("--stream",
+                        type=int,
+                        default=0,
+                        metavar="ROWS",
+                        help="Process the csv in chunks of this many rows.")
+    parser.add_argument("--table",
+                        type=str,
+                        default=None,
+                        help=f"Lobe count table, {LOBE_COUNTS_NAME} next to "
+                        f"pickle_dir by default. Only new or changed pickles "
+                        f"are read into it.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Number of worker processes.")
+    parser.add_argument("--chunksize",
+                        type=int,
+                        default=64,
+                        help="Pickles sent to a worker at a time when "
+                        "refreshing the table.")
     args = parser.parse_args()
 
     main(args)
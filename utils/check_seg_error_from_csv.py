@@ -1,24 +1,64 @@
 #!/usr/bin/env python3
 
+import argparse
+from collections import Counter
+
 import pandas as pd
-import numpy as np
 
-df = pd.read_csv(input("Enter input csv: "))
+from src.atomic import atomic_path
+from src.qc import DEFAULT_RULES, QCRules
 
 
-def check_row(tlv, airvol, tcount):
-    lungs = tlv > 8.0 or tlv < 3.0
-    airs = airvol > 0.4 or airvol < 0.08
-    counts = tcount > 400 or tcount < 150
+def main(args):
 
-    if lungs or airs or counts:
-        return 1
+    rules = QCRules.from_file(args.rules)
+    # Columns are read as text and written back untouched, so chunks with
+    # different inferred dtypes can't change the output.
+    if args.stream:
+        chunks = pd.read_csv(args.input_csv,
+                             dtype=str,
+                             keep_default_na=False,
+                             chunksize=args.stream)
     else:
-        return 0
+        chunks = [
+            pd.read_csv(args.input_csv, dtype=str, keep_default_na=False)
+        ]
+
+    failing = Counter()
+    flagged = 0
+    total = 0
+    with atomic_path(args.output_csv) as tmp_path:
+        for i, df in enumerate(chunks):
+            rules.flag(df)
+            failing.update(rules.counts(df.bp_qc_reasons))
+            flagged += df.bp_seg_error.sum()
+            total += len(df)
+            df.to_csv(tmp_path, mode="w" if i == 0 else "a", header=i == 0)
+
+    for rule in rules.rules:
+        print(f"{rule.name}: {failing[rule.name]} failing")
+    print(f"{flagged} of {total} flagged")
 
 
-df['bp_seg_error'] = np.where(
-    (df.bp_tlv > 8.0) | (df.bp_airvol > 0.4) | (df.bp_tlv < 3.0) |
-    (df.bp_airvol < 0.08) | (df.bp_tcount < 150), 1, 0)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_csv",
+                        type=str,
+                        help="Path to the merged summary file.")
+    parser.add_argument("output_csv",
+                        type=str,
+                        nargs="?",
+                        default="merged_summary_2_corrected.csv",
+                        help="Path for the flagged summary.")
+    parser.add_argument("--rules",
+                        type=str,
+                        default=str(DEFAULT_RULES),
+                        help="YAML file of QC rules.")
+    parser.add_argument("--stream",
+                        type=int,
+                        default=0,
+                        metavar="ROWS",
+                        help="Process the csv in chunks of this many rows.")
+    args = parser.parse_args()
 
-df.to_csv("merged_summary_2_corrected.csv")
+    main(args)
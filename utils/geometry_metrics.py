@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+import argparse
+import os
+import time
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from src.incremental import index_files, update_table
+
+METRICS_NAME = "geometry_metrics.parquet"
+
+
+def compute_metrics(seg_path: str) -> dict:
+    """
+    Geometry metrics of one segmentation, read through the memory-mapped dataobj.
+    :param seg_path: Nifti segmentation path.
+    :return: dict of metric -> value
+    """
+    mask = np.asanyarray(nib.load(seg_path).dataobj) != 0
+
+    metrics = {"geo_voxels": int(np.count_nonzero(mask))}
+    box = []
+    for axis, name in enumerate("xyz"):
+        other = tuple(a for a in range(3) if a != axis)
+        profile = mask.any(axis=other)
+        nonzero = np.flatnonzero(profile)
+        extent = int(nonzero[-1] - nonzero[0] + 1) if nonzero.size else 0
+        metrics[f"geo_extent_{name}"] = extent
+        box.append(slice(nonzero[0], nonzero[-1] + 1) if nonzero.size else
+                   slice(0, 0))
+        # Foreground area of the projection along this axis.
+        metrics[f"geo_proj_{name}"] = int(
+            np.count_nonzero(mask.any(axis=axis)))
+
+    components, n_components = ndimage.label(mask[tuple(box)],
+                                             structure=np.ones((3, 3, 3)))
+    metrics["geo_components"] = int(n_components)
+    if n_components:
+        sizes = np.bincount(components.ravel())[1:]
+        metrics["geo_largest_fraction"] = float(sizes.max() /
+                                                metrics["geo_voxels"])
+    else:
+        metrics["geo_largest_fraction"] = 0.0
+    return metrics
+
+
+def _process(path: str) -> dict:
+    try:
+        return compute_metrics(path)
+    except Exception as e:
+        print(f"Error processing {path}\n{e}")
+        return None
+
+
+def main(args):
+
+    start = time.perf_counter()
+    output = Path(args.output or Path(args.seg_dir).parent / METRICS_NAME)
+    files = index_files(args.seg_dir)
+    # Failed segmentations stay out of the table and are retried next run.
+    table, computed = update_table(files, output, _process, args.workers,
+                                   chunksize=4)
+
+    elapsed = time.perf_counter() - start
+    print(f"Processed {computed} new or changed segmentations in "
+          f"{elapsed:.1f}s")
+    print(f"{len(table)} cases in {output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("seg_dir",
+                        type=str,
+                        help="Directory containing nifti segmentations.")
+    parser.add_argument("--output",
+                        type=str,
+                        default=None,
+                        help=f"Metrics table, {METRICS_NAME} next to "
+                        f"seg_dir by default.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Number of worker processes.")
+    args = parser.parse_args()
+
+    main(args)
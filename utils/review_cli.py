@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.columnar import REVIEW_COLUMNS, TIMING_COLUMNS
+from src.dataloader import DataLoader, pid_key
+from src.qc import DEFAULT_RULES, QCRules
+
+SCORE_COLUMNS = ["bp_leak_score", "bp_segmental_score", "bp_subsegmental_score"]
+
+
+def parse_assignment(text: str) -> tuple:
+    """
+    Parses COLUMN=VALUE, with integer values for numeric review columns.
+    """
+    column, _, value = text.partition("=")
+    if not column.startswith("bp_"):
+        raise argparse.ArgumentTypeError(f"{column} is not a bp_ column")
+    default = REVIEW_COLUMNS.get(column, ("", None))[0]
+    if not isinstance(default, str):
+        value = int(value)
+    return column, value
+
+
+def normalise(values: pd.Series, column: str) -> pd.Series:
+    """
+    Brings a review column read from another file to the loader's types:
+    numbers for numeric review columns and text, with blanks as "", otherwise.
+    """
+    default = REVIEW_COLUMNS.get(column, ("", None))[0]
+    if isinstance(default, str):
+        return values.astype(object).where(values.notna(), "").astype(str)
+    return pd.to_numeric(values, errors="coerce")
+
+
+def read_reviews(path, columns=None) -> pd.DataFrame:
+    """
+    Reads the bp_ columns of a reviewer's csv, indexed by participant key.
+    """
+    df = pd.read_csv(path)
+    columns = columns or [
+        c for c in df if c.startswith("bp_") and c not in TIMING_COLUMNS
+    ]
+    if "bp_reviewed" not in columns:
+        # Kept so unreviewed rows can be told apart.
+        columns = ["bp_reviewed"] + list(columns)
+    df = df[["participant_id"] + [c for c in columns if c in df]]
+    df.index = df.participant_id.map(pid_key)
+    df = df[~df.index.duplicated(keep="last")].drop(columns="participant_id")
+    return df.apply(lambda values: normalise(values, values.name))
+
+
+def open_loader(args, rules: QCRules = None) -> DataLoader:
+    """
+    :param rules: QC rules whose columns a columnar summary must load.
+    """
+    start = time.perf_counter()
+    loader = DataLoader(args.image_dir, args.seg_dir, args.summary,
+                        columnar=args.columnar,
+                        columns=rules.columns if rules else ())
+    print(f"Loaded {len(loader.flagged_df)} cases in "
+          f"{time.perf_counter() - start:.1f}s")
+    return loader
+
+
+def finish(loader: DataLoader, changed: int, dry_run: bool):
+    if dry_run or changed == 0:
+        # Nothing was journalled, so there is nothing to compact.
+        loader.journal.close()
+        return
+    start = time.perf_counter()
+    loader.close()
+    print(f"Saved {changed} changes in {time.perf_counter() - start:.1f}s")
+
+
+def apply_updates(loader: DataLoader, rows: np.ndarray, updates: dict,
+                  dry_run: bool) -> int:
+    """
+    Applies column -> values (scalar or aligned with rows) to flagged_df rows.
+    """
+    changed = 0
+    for column, values in updates.items():
+        if dry_run:
+            current = loader.flagged_df[column].to_numpy()[rows]
+            changed += int(np.count_nonzero(current != np.asarray(values)))
+        else:
+            changed += loader.set_values(rows, column, values)
+    return changed
+
+
+def apply_rules(args):
+    """
+    Sets review columns on every case that passes (or fails) all QC rules.
+    """
+    rules = QCRules.from_file(args.rules)
+    loader = open_loader(args, rules)
+    df = loader.flagged_df
+    reasons = rules.reasons(df)
+    selected = reasons != 0 if args.failing else reasons == 0
+    if not args.include_reviewed:
+        selected &= df.bp_reviewed.to_numpy() != 1
+    rows = np.flatnonzero(selected)
+    updates = dict(args.set or [("bp_reviewed", 1)])
+    changed = apply_updates(loader, rows, updates, args.dry_run)
+    print(f"{len(rows)} cases {'failing' if args.failing else 'passing'} "
+          f"{len(rules.rules)} rules, {changed} values "
+          f"{'would change' if args.dry_run else 'changed'}")
+    finish(loader, changed, args.dry_run)
+
+
+def import_reviews(args):
+    """
+    Copies review columns from another reader's csv, joined on participant_id.
+    Cases this reviewer already reviewed with different values are conflicts
+    and are left alone unless --overwrite is given.
+    """
+    loader = open_loader(args)
+    df = loader.flagged_df
+    other = read_reviews(args.other_csv, args.columns)
+    if not args.all_rows and "bp_reviewed" in other:
+        other = other[other.bp_reviewed == 1]
+
+    keys = df.participant_id.map(pid_key)
+    matched = keys.isin(other.index).to_numpy()
+    rows = np.flatnonzero(matched)
+    source = other.loc[keys[matched]]
+    print(f"{len(rows)} of {len(other)} imported cases found in the summary")
+
+    reviewed = df.bp_reviewed.to_numpy()[rows] == 1
+    differs = np.zeros(len(rows), dtype=bool)
+    for column in source:
+        values = source[column].to_numpy()
+        current = normalise(df[column].iloc[rows], column).to_numpy()
+        differs |= pd.notna(values) & (current != values)
+    conflicts = reviewed & differs
+    if conflicts.any():
+        print(f"{conflicts.sum()} already reviewed cases differ"
+              f"{', overwriting' if args.overwrite else ', skipped'}")
+        if args.report:
+            report = pd.concat([
+                df.iloc[rows[conflicts]][["participant_id"] +
+                                         list(source.columns)].reset_index(
+                                             drop=True),
+                source[conflicts].reset_index(drop=True).add_suffix(
+                    "_imported")
+            ], axis=1)
+            report.to_csv(args.report, index=False)
+            print(f"Wrote conflicts to {args.report}")
+    if not args.overwrite:
+        rows, source = rows[~conflicts], source[~conflicts]
+
+    changed = 0
+    for column in source:
+        values = source[column].to_numpy()
+        known = pd.notna(values)
+        changed += apply_updates(loader, rows[known], {column: values[known]},
+                                 args.dry_run)
+    print(f"{changed} values {'would change' if args.dry_run else 'changed'}")
+    finish(loader, changed, args.dry_run)
+
+
+def merge_reviews(args):
+    """
+    Compares reviewers' csvs case by case and reports where they disagree.
+    With --apply, cases every reviewer reviewed and agrees on are written to
+    the summary.
+    """
+    loader = open_loader(args)
+    reviews = {
+        Path(path).stem: read_reviews(path, args.columns)
+        for path in args.reviewer_csvs
+    }
+    for name, df in reviews.items():
+        if "bp_reviewed" in df:
+            reviews[name] = df[df.bp_reviewed == 1]
+        print(f"{name}: {len(reviews[name])} reviewed cases")
+    columns = [c for c in (args.columns or list(REVIEW_COLUMNS))
+               if c != "bp_reviewed" and c not in TIMING_COLUMNS
+               and all(c in df for df in reviews.values())]
+
+    conflicts = []
+    agreed = {}
+    disagree = None
+    for column in columns:
+        wide = pd.DataFrame({name: df[column] for name, df in reviews.items()})
+        first = wide.bfill(axis=1).iloc[:, 0]
+        differs = (wide.notna() & wide.ne(first, axis=0)).any(axis=1)
+        # A case missing from any reviewer is no consensus, though it has
+        # nothing to conflict with.
+        unsettled = differs | ~wide.notna().all(axis=1)
+        disagree = unsettled if disagree is None else disagree | unsettled
+        agreed[column] = first
+        if differs.any():
+            table = wide[differs].rename_axis("participant_id").reset_index()
+            table.insert(1, "column", column)
+            conflicts.append(table)
+        print(f"{column}: {int(differs.sum())} conflicts")
+
+    if conflicts:
+        report = pd.concat(conflicts, ignore_index=True)
+        report.to_csv(args.report, index=False)
+        print(f"Wrote {len(report)} conflicts on "
+              f"{report.participant_id.nunique()} cases to {args.report}")
+
+    changed = 0
+    if args.apply and disagree is not None:
+        keys = loader.flagged_df.participant_id.map(pid_key)
+        consensus = disagree.index[~disagree.to_numpy()]
+        if not args.overwrite:
+            reviewed = keys[loader.flagged_df.bp_reviewed == 1]
+            consensus = consensus.difference(pd.Index(reviewed))
+        matched = keys.isin(consensus).to_numpy()
+        rows = np.flatnonzero(matched)
+        for column in columns:
+            values = agreed[column].reindex(keys[matched]).to_numpy()
+            known = pd.notna(values)
+            changed += apply_updates(loader, rows[known],
+                                     {column: values[known]}, args.dry_run)
+        changed += apply_updates(loader, rows, {"bp_reviewed": 1},
+                                 args.dry_run)
+        print(f"{len(rows)} agreed cases, {changed} values "
+              f"{'would change' if args.dry_run else 'changed'}")
+    finish(loader, changed, args.dry_run)
+
+
+def export_stats(args):
+    """
+    Per-reason counts and score distributions, printed and optionally written
+    as a long-format csv of (statistic, value, count).
+    """
+    rules = QCRules.from_file(args.rules) if args.rules else None
+    loader = open_loader(args, rules)
+    df = loader.flagged_df
+    reviewed = df.bp_reviewed == 1
+    rows = [
+        ("cases", "all", len(df)),
+        ("cases", "flagged", int((df.bp_seg_error == 1).sum())),
+        ("cases", "reviewed", int(reviewed.sum())),
+        ("cases", "inspect", int((df.bp_inspect == 1).sum())),
+    ]
+    reasons = df.bp_err_reason.fillna("").astype(str)
+    for reason, count in reasons[reasons != ""].value_counts().items():
+        rows.append(("bp_err_reason", reason, int(count)))
+    for column in SCORE_COLUMNS:
+        scores = pd.to_numeric(df[column], errors="coerce")
+        # -1 is the unscored default.
+        scores = scores[reviewed & (scores != -1)]
+        for score, count in scores.value_counts().sort_index().items():
+            rows.append((column, score, int(count)))
+    if "bp_dwell_s" in df:
+        dwell = pd.to_numeric(df.bp_dwell_s, errors="coerce")
+        dwell = dwell[reviewed & (dwell > 0)]
+        for q in (50, 95) if len(dwell) else ():
+            rows.append(("dwell_s", f"p{q}",
+                         round(float(dwell.quantile(q / 100)), 1)))
+    if rules is not None:
+        for name, count in rules.counts(rules.reasons(df)).items():
+            rows.append(("qc_failing", name, count))
+
+    stats = pd.DataFrame(rows, columns=["statistic", "value", "count"])
+    for statistic, group in stats.groupby("statistic", sort=False):
+        print(statistic)
+        for value, count in zip(group.value, group["count"]):
+            print(f"  {value}: {count}")
+    if args.output:
+        stats.to_csv(args.output, index=False)
+        print(f"Wrote {args.output}")
+    finish(loader, 0, True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Review triage without the viewer.")
+    parser.add_argument("summary",
+                        type=str,
+                        help="Summary csv, parquet or feather file.")
+    parser.add_argument("--image-dir",
+                        type=str,
+                        default=None,
+                        help="Image directory, only used to report missing files.")
+    parser.add_argument("--seg-dir",
+                        type=str,
+                        default=None,
+                        help="Segmentation directory, only used to report "
+                        "missing files.")
+    parser.add_argument("--columnar",
+                        action="store_true",
+                        help="Work on a parquet copy of a csv summary.")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="Report what would change without saving.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rules_parser = commands.add_parser(
+        "apply-rules", help="Set review columns on cases by QC result.")
+    rules_parser.add_argument("--rules",
+                              type=str,
+                              default=str(DEFAULT_RULES),
+                              help="YAML file of QC rules.")
+    rules_parser.add_argument("--set",
+                              type=parse_assignment,
+                              action="append",
+                              metavar="COLUMN=VALUE",
+                              help="Value to set, bp_reviewed=1 by default. "
+                              "Repeat for several columns.")
+    rules_parser.add_argument("--failing",
+                              action="store_true",
+                              help="Select cases failing any rule instead of "
+                              "those passing all of them.")
+    rules_parser.add_argument("--include-reviewed",
+                              action="store_true",
+                              help="Also change cases already reviewed.")
+    rules_parser.set_defaults(func=apply_rules)
+
+    import_parser = commands.add_parser(
+        "import", help="Copy review columns from another reader's csv.")
+    import_parser.add_argument("other_csv", type=str)
+    import_parser.add_argument("--columns",
+                               nargs="+",
+                               default=None,
+                               help="bp_ columns to copy, all by default.")
+    import_parser.add_argument("--all-rows",
+                               action="store_true",
+                               help="Also copy rows the other reader has not "
+                               "marked reviewed.")
+    import_parser.add_argument("--overwrite",
+                               action="store_true",
+                               help="Overwrite cases already reviewed here.")
+    import_parser.add_argument("--report",
+                               type=str,
+                               default=None,
+                               help="Csv to write conflicting cases to.")
+    import_parser.set_defaults(func=import_reviews)
+
+    merge_parser = commands.add_parser(
+        "merge", help="Report conflicts between reviewers' csvs.")
+    merge_parser.add_argument("reviewer_csvs", type=str, nargs="+")
+    merge_parser.add_argument("--columns",
+                              nargs="+",
+                              default=None,
+                              help="Review columns to compare, all by default.")
+    merge_parser.add_argument("--report",
+                              type=str,
+                              default="review_conflicts.csv",
+                              help="Csv to write conflicts to.")
+    merge_parser.add_argument("--apply",
+                              action="store_true",
+                              help="Write cases every reviewer agrees on to "
+                              "the summary.")
+    merge_parser.add_argument("--overwrite",
+                              action="store_true",
+                              help="With --apply, also overwrite cases already "
+                              "reviewed here.")
+    merge_parser.set_defaults(func=merge_reviews)
+
+    stats_parser = commands.add_parser(
+        "stats", help="Per-reason counts and score distributions.")
+    stats_parser.add_argument("--output",
+                              type=str,
+                              default=None,
+                              help="Csv to write the statistics to.")
+    stats_parser.add_argument("--rules",
+                              type=str,
+                              default=None,
+                              help="Also count cases failing each QC rule.")
+    stats_parser.set_defaults(func=export_stats)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,15 +1,40 @@
 #!/usr/bin/env python3
 
 import argparse
-import re
-import multiprocessing as mp
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 import matplotlib.pyplot as plt
 import nibabel as nib
+from PIL import Image
 from tqdm import tqdm
 
+from src.atomic import atomic_path
+from src.crop import crop, load_cropped
+from src.dataloader import parse_pid
+
+MANIFEST_NAME = ".thumbnail_manifest.jsonl"
+PREVIEW_DIR = "previews"
+EXTENSIONS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp"}
+# Settings of manifest entries written before output options existed.
+LEGACY_SETTINGS = {
+    "renderer": "lean",
+    "format": "jpeg",
+    "quality": 75,
+    "size": [4200, 1200],
+    "preview_width": 0
+}
+# Jobs per worker before its pool is replaced, so fragmented heaps are given
+# back.
+RECYCLE_EVERY = 64
+
 plt.rcParams.update({
     "savefig.facecolor": "black",
     "savefig.edgecolor": "black"
@@ -21,45 +46,108 @@ def crop_image(image: np.ndarray, padding: tuple = (0, 0, 0)) -> np.ndarray:
     Crop a 3D mask to minimum size + padding
     :param image: 3D mask
     :param padding: voxels to pad in the x, y, z axes
-    :return: cropped 3D mask
-    """
-
-    def fit_to_image(boundbox: tuple):
-        # get the max between x1 and 0 (lower bound)
-        # and min between x2 and max image size (upper bound)
-        fx1 = (max(boundbox[0][0], 0), min(boundbox[0][1], image.shape[0]))
-        fy1 = (max(boundbox[1][0], 0), min(boundbox[1][1], image.shape[1]))
-        fz1 = (max(boundbox[2][0], 0), min(boundbox[2][1], image.shape[2]))
-        return fx1, fy1, fz1
-
-    # Find the coordinates of the largest rectangle with the mask.
-    idx_mask = np.argwhere(
-        image != 0
-    )  # Get the coordinates of the non-zero elements (tilde is an inverse of the mask)
-    x1 = (
-        min(idx_mask[:, 0]) - padding[0]
-    )  # Get the minimum x coordinate of the non-zero elements and pad it with the borders
-    x2 = (
-        max(idx_mask[:, 0]) + padding[0]
-    )  # Get the maximum x coordinate of the non-zero elements and pad it with the borders
-    y1 = min(idx_mask[:, 1]) - padding[1]
-    y2 = max(idx_mask[:, 1]) + padding[1]
-    z1 = min(idx_mask[:, 2]) - padding[2]
-    z2 = max(idx_mask[:, 2]) + padding[2]
-
-    coords = fit_to_image(
-        ((x1, x2), (y1, y2),
-         (z1, z2)))  # Make sure the bounding box is within the image.
-    cropped_img = image[coords[0][0]:coords[0][1], coords[1][0]:coords[1][1],
-                        coords[2][0]:coords[2][1], ]  # Crop the image.
-    return cropped_img
-
-
-def process_segmentation(in_seg):
+    :return: cropped 3D mask, a view of image
+    """
+    return crop(image, padding)
+
+
+def _to_gray(projection: np.ndarray) -> np.ndarray:
+    # Same linear min/max scaling imshow applies with the gray colormap.
+    low, high = projection.min(), projection.max()
+    if high == low:
+        return np.zeros(projection.shape, dtype=np.uint8)
+    scaled = (projection - low) * (255.0 / (high - low))
+    return scaled.round().astype(np.uint8)
+
 
+def render_projections(projections, size: tuple = (4200, 1200),
+                       pad: int = 15) -> Image.Image:
+    """
+    Lays out projections side by side on black, each fitted to its panel.
+    Mirrors the 42x12 inch, 100 dpi tight_layout figure of the matplotlib path.
+    :param projections: 2D arrays, one per panel.
+    :param size: output width and height in pixels.
+    :param pad: border around each panel in pixels.
+    :return: grayscale PIL image
+    """
+    width, height = size
+    panel_w = width // len(projections)
+    canvas = Image.new("L", size)
+    for i, projection in enumerate(projections):
+        panel = Image.fromarray(_to_gray(projection))
+        scale = min((panel_w - 2 * pad) / panel.width,
+                    (height - 2 * pad) / panel.height)
+        fitted = (max(round(panel.width * scale), 1),
+                  max(round(panel.height * scale), 1))
+        panel = panel.resize(fitted, Image.HAMMING)
+        canvas.paste(panel, (i * panel_w + (panel_w - fitted[0]) // 2,
+                             (height - fitted[1]) // 2))
+    return canvas
+
+
+def render_thumbnail_lean(in_seg, size: tuple = (4200, 1200),
+                          coarse_step: int = None) -> Image.Image:
+    """
+    Renders the three projections of a segmentation without a float64 copy
+    of the volume or a matplotlib figure.
+    The output is grayscale and its panels are placed differently from the
+    matplotlib figure, so it is not a drop-in replacement for those images.
+    :param coarse_step int: Find the crop with a strided scan first, see
+        src.crop.load_cropped.
+    """
+    # Native dtype, and only the cropped region is read with coarse_step.
+    air_seg, _ = load_cropped(in_seg, (4, 4, 4), coarse_step)
+    if air_seg.size == 0:
+        raise ValueError("empty segmentation")
+    return render_projections([
+        np.rot90(air_seg.sum(axis=0, dtype=np.float64)),
+        np.rot90(air_seg.sum(axis=1, dtype=np.float64)),
+        air_seg.sum(axis=2, dtype=np.float64),
+    ], size)
+
+
+def output_path(in_seg: Path, output_dir: Path = None,
+                fmt: str = "jpeg") -> Path:
+    """
+    Thumbnail path of a segmentation, images/ next to its directory by default.
+    """
+    id_name = parse_pid(in_seg)
+    output_dir = Path(output_dir or in_seg.parent.parent / "images")
+    return output_dir / f"{id_name}{EXTENSIONS[fmt]}"
+
+
+def preview_path(out_path: Path) -> Path:
+    return out_path.parent / PREVIEW_DIR / out_path.name
+
+
+def save_image(image: Image.Image, path: Path, fmt: str = "jpeg",
+               quality: int = 75):
+    """
+    Saves through a temporary file and rename, so an interrupted run never
+    leaves a truncated image behind.
+    """
+    with atomic_path(path) as tmp_path:
+        if fmt == "png":
+            # Lossless; quality does not apply.
+            image.save(tmp_path, format="PNG", optimize=True)
+        elif fmt == "webp":
+            image.save(tmp_path, format="WEBP", quality=quality, method=4)
+        else:
+            image.save(tmp_path, format="JPEG", quality=quality,
+                       optimize=True)
+
+
+def render_thumbnail_matplotlib(in_seg, size: tuple = (4200, 1200)) -> Image.Image:
+    """
+    Renders the three projections as hanning-interpolated matplotlib panels.
+    """
     air_seg = nib.load(in_seg).get_fdata()
     air_seg = crop_image(air_seg, padding=(4, 4, 4))
-    f, axarr = plt.subplots(1, 3, figsize=(42, 12))
+    if air_seg.size == 0:
+        raise ValueError("empty segmentation")
+    f, axarr = plt.subplots(1, 3, figsize=(size[0] / 100, size[1] / 100))
+    # Drawn straight to a buffer, so savefig.facecolor does not apply.
+    f.patch.set_facecolor("black")
     axarr[0].imshow(np.rot90(air_seg.sum(axis=0)),
                     interpolation="hanning",
                     cmap="gray")
@@ -71,22 +159,410 @@ def process_segmentation(in_seg):
     axarr[1].axis("off")
     axarr[2].axis("off")
     plt.tight_layout()
-    id_name = re.search(r'\d{6}', str(in_seg)).group()
-    f.savefig(f"{in_seg.parent.parent}/images/{id_name}.jpg")
-    plt.close()
+    f.canvas.draw()
+    image = Image.frombuffer("RGBA", f.canvas.get_width_height(),
+                             f.canvas.buffer_rgba()).convert("RGB")
+    plt.close(f)
+    return image
+
+
+def process_segmentation(in_seg,
+                         lean: bool = False,
+                         output_dir: Path = None,
+                         fmt: str = "jpeg",
+                         quality: int = 75,
+                         size: tuple = (4200, 1200),
+                         preview_width: int = 0,
+                         coarse_step: int = None) -> tuple:
+    """
+    Renders and saves the thumbnail of one segmentation.
+    :param lean bool: Use the lean PIL writer rather than matplotlib.
+    :param output_dir: Output directory, images/ next to the input's by default.
+    :param fmt str: jpeg, png or webp.
+    :param quality int: jpeg/webp quality.
+    :param size: Full image width and height in pixels.
+    :param preview_width int: Width of a low resolution copy saved to
+        previews/ in the output directory, 0 for none.
+    :param coarse_step int: Lean writer only, crop with a strided scan first.
+    :return: (image path, preview path or None)
+    """
+    out_path = output_path(in_seg, output_dir, fmt)
+    if lean:
+        image = render_thumbnail_lean(in_seg, size, coarse_step)
+    else:
+        image = render_thumbnail_matplotlib(in_seg, size)
+    save_image(image, out_path, fmt, quality)
+
+    if not preview_width:
+        return str(out_path), None
+    preview = preview_path(out_path)
+    preview.parent.mkdir(exist_ok=True)
+    height = max(round(image.height * preview_width / image.width), 1)
+    save_image(image.resize((preview_width, height), Image.HAMMING), preview,
+               fmt, quality)
+    return str(out_path), str(preview)
+
+
+def file_signature(path: Path, content_hash: bool = False) -> dict:
+    """
+    Size and mtime of a file, plus its sha1 if content_hash is set.
+    """
+    stat = path.stat()
+    signature = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if content_hash:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        signature["sha1"] = sha1.hexdigest()
+    return signature
+
+
+def load_manifest(manifest_path: Path) -> dict:
+    """
+    Reads the thumbnail manifest, later lines overriding earlier ones.
+    :return: dict of resolved input path -> manifest entry
+    """
+    manifest = {}
+    if not manifest_path.is_file():
+        return manifest
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by an interrupted run.
+                continue
+            # Entries written with relative paths match the resolved ones.
+            manifest[str(Path(entry["input"]).resolve())] = entry
+    return manifest
+
+
+def write_manifest(manifest_path: Path, manifest: dict):
+    with atomic_path(manifest_path) as tmp_path, open(tmp_path, "w") as f:
+        for entry in manifest.values():
+            f.write(json.dumps(entry) + "\n")
+
+
+def is_current(seg: Path, entry: dict, content_hash: bool,
+               settings: dict = None) -> bool:
+    """
+    Checks a manifest entry against the segmentation it was rendered from,
+    and against the output settings if given.
+    """
+    if entry is None or not Path(entry["output"]).is_file():
+        return False
+    if settings is not None and entry.get("settings",
+                                          LEGACY_SETTINGS) != settings:
+        return False
+    if entry.get("preview") and not Path(entry["preview"]).is_file():
+        return False
+    signature = file_signature(seg)
+    if (signature["size"], signature["mtime"]) == (entry["size"],
+                                                   entry["mtime"]):
+        return True
+    if content_hash and "sha1" in entry:
+        # Touched but unchanged files only need their manifest entry updated.
+        signature = file_signature(seg, content_hash=True)
+        if signature["sha1"] == entry["sha1"]:
+            entry.update(signature)
+            return True
+    return False
+
+
+def _read_int(path: str):
+    try:
+        with open(path) as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def available_cpus() -> int:
+    """
+    CPUs this process may use: its affinity mask, capped by a cgroup CPU quota
+    (v2 cpu.max or v1 cfs_quota_us) when running in a container.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota, period = None, None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            fields = f.read().split()
+        if fields[0] != "max":
+            quota, period = int(fields[0]), int(fields[1])
+    except (OSError, ValueError, IndexError):
+        quota = _read_int("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        period = _read_int("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and quota > 0:
+        cpus = min(cpus, max(quota // period, 1))
+    return cpus
+
+
+def available_memory() -> int:
+    """
+    Bytes of memory available to this process: MemAvailable, capped by the
+    cgroup memory limit less its current usage. None if unknown.
+    """
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    for limit_path, usage_path in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        ("/sys/fs/cgroup/memory/memory.limit_in_bytes",
+         "/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+    ):
+        limit = _read_int(limit_path)
+        if limit is None:
+            continue
+        headroom = limit - (_read_int(usage_path) or 0)
+        available = headroom if available is None else min(available, headroom)
+        break
+    return available
+
+
+def job_memory(in_seg: Path, lean: bool = True) -> int:
+    """
+    Estimated peak bytes of rendering one segmentation, from its header.
+    The lean path holds the native volume plus boolean projections; the
+    matplotlib path holds float64 volumes from get_fdata() and the crop.
+    """
+    header = nib.load(in_seg).header
+    voxels = int(np.prod(header.get_data_shape()))
+    if lean:
+        return voxels * (header.get_data_dtype().itemsize + 1)
+    return voxels * 8 * 2
+
+
+def _limit_worker_memory(limit_bytes: int):
+    # Caps the worker's address space so a runaway volume raises MemoryError
+    # in that worker instead of bringing down the machine.
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+
+
+def _render_job(in_seg: Path, **options):
+    """
+    Renders one thumbnail, returning the error instead of raising so one bad
+    file does not end the run.
+    :return: (input path, (image path, preview path) or None, error or None)
+    """
+    try:
+        if parse_pid(in_seg) is None:
+            raise ValueError("no 6 digit participant ID in file name")
+        return in_seg, process_segmentation(in_seg, **options), None
+    except MemoryError:
+        return in_seg, None, "out of memory"
+    except Exception as e:
+        return in_seg, None, f"{type(e).__name__}: {e}"
+
+
+def schedule(segs: list, workers: int, lean: bool = True,
+             worker_mem_mb: int = None) -> tuple:
+    """
+    Orders jobs largest-first and sizes the pool for them.
+    Large volumes start first so they do not straggle at the end of the run,
+    and the worker count is capped so the largest jobs running at once fit in
+    available memory.
+    :return: (ordered jobs, workers, per-worker memory limit or None)
+    """
+    sizes = {seg: seg.stat().st_size for seg in segs}
+    jobs = sorted(segs, key=lambda seg: sizes[seg], reverse=True)
+    workers = max(min(workers, len(jobs)), 1)
+
+    limit = worker_mem_mb * (1 << 20) if worker_mem_mb else None
+    available = available_memory()
+    if jobs and available:
+        try:
+            peak = job_memory(jobs[0], lean)
+        except Exception:
+            peak = sizes[jobs[0]]
+        per_worker = max(peak, limit or 0)
+        if per_worker:
+            workers = max(min(workers, available // per_worker), 1)
+    return jobs, workers, limit
+
+
+def _run_alone(render, segs: list, initializer, initargs):
+    # One pool per job, so a job that kills its worker breaks only its own.
+    executors = [
+        ProcessPoolExecutor(1, initializer=initializer, initargs=initargs)
+        for _ in segs
+    ]
+    try:
+        futures = [e.submit(render, seg) for e, seg in zip(executors, segs)]
+        for seg, future in zip(segs, futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                yield seg, None, "worker process died"
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+
+def run_jobs(render, jobs: list, workers: int, limit: int = None):
+    """
+    Runs render over jobs in process pools, yielding (input, outputs, error)
+    for every job as it finishes.
+    A worker killed outright, by the OOM killer or a segfault, breaks its
+    pool and every job still in it. The jobs that may have been running are
+    then retried in a pool each, so only the one that kills its worker again
+    is reported as failed, and the others go back to the queue.
+    :param limit int: Per-worker address space limit in bytes, or None.
+    """
+    initializer = _limit_worker_memory if limit else None
+    initargs = (limit, ) if limit else ()
+    pending = list(jobs)
+    while pending:
+        batch = pending[:workers * RECYCLE_EVERY]
+        pending = pending[workers * RECYCLE_EVERY:]
+        broken = []
+        with ProcessPoolExecutor(workers,
+                                 initializer=initializer,
+                                 initargs=initargs) as executor:
+            futures = {executor.submit(render, seg): seg for seg in batch}
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    broken.append(futures[future])
+        if not broken:
+            continue
+        # Jobs are handed out in submission order, with up to workers + 1
+        # queued behind the running ones; the rest cannot have started.
+        order = {seg: i for i, seg in enumerate(batch)}
+        broken.sort(key=order.get)
+        suspects = broken[:2 * workers + 1]
+        for start in range(0, len(suspects), workers):
+            yield from _run_alone(render, suspects[start:start + workers],
+                                  initializer, initargs)
+        pending = broken[2 * workers + 1:] + pending
 
 
 def main(args):
-    list_segs = [f for f in Path(args.in_seg).iterdir() if f.is_file()]
+    start = time.perf_counter()
+    # Resolved, so the manifest matches however the directories are given.
+    in_dir = Path(args.in_seg).resolve()
+    list_segs = [f for f in in_dir.iterdir() if f.is_file()]
     list_segs.sort()
-    p = mp.Pool(16)
-    list(tqdm(p.imap(process_segmentation, list_segs), total=len(list_segs)))
-    p.close()
-    p.join()
+    lean = args.lean
+    output_dir = Path(args.output_dir or in_dir.parent / "images").resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    size = [int(n) for n in args.size.lower().split("x")]
+    settings = {
+        "renderer": "lean" if lean else "matplotlib",
+        "format": args.format,
+        "quality": args.quality,
+        "size": size,
+        "preview_width": args.preview_width
+    }
+    render = partial(_render_job,
+                     lean=lean,
+                     output_dir=output_dir,
+                     fmt=args.format,
+                     quality=args.quality,
+                     size=tuple(size),
+                     preview_width=args.preview_width,
+                     coarse_step=args.coarse_step)
+
+    if args.incremental:
+        manifest_path = output_dir / MANIFEST_NAME
+        manifest = load_manifest(manifest_path)
+
+        todo = [
+            seg for seg in list_segs
+            if not is_current(seg, manifest.get(str(seg)), args.hash, settings)
+        ]
+        current = {str(seg) for seg in list_segs}
+        stale = [key for key in manifest if key not in current]
+        kept_outputs = {
+            entry.get(name)
+            for key, entry in manifest.items() if key in current
+            for name in ("output", "preview")
+        }
+        for key in stale:
+            entry = manifest.pop(key)
+            for output in (entry["output"], entry.get("preview")):
+                if (output and output not in kept_outputs
+                        and os.path.isfile(output)):
+                    os.remove(output)
+        write_manifest(manifest_path, manifest)
+        signatures = {str(seg): file_signature(seg, args.hash) for seg in todo}
+    else:
+        todo = list_segs
+
+    jobs, workers, limit = schedule(todo, args.workers, lean,
+                                    args.worker_mem_mb)
+    print(f"Rendering {len(jobs)} thumbnails with {workers} workers")
+
+    rendered, failures, total_bytes = 0, [], 0
+    journal = open(manifest_path, "a") if args.incremental else None
+    results = run_jobs(render, jobs, workers, limit)
+    for seg, outputs, error in tqdm(results, total=len(jobs)):
+        if error is not None:
+            failures.append((seg, error))
+            tqdm.write(f"Failed {seg}: {error}")
+            continue
+        rendered += 1
+        total_bytes += seg.stat().st_size
+        if journal is not None:
+            previous = manifest.get(str(seg))
+            if previous is not None:
+                # Outputs of other settings, e.g. {pid}.jpg after switching
+                # to webp, would otherwise shadow the new image in the viewer.
+                for name, output in zip(("output", "preview"), outputs):
+                    old = previous.get(name)
+                    if old and old != output and os.path.isfile(old):
+                        os.remove(old)
+            entry = {
+                "input": str(seg),
+                "output": outputs[0],
+                "preview": outputs[1],
+                "settings": settings
+            }
+            entry.update(signatures[str(seg)])
+            # Appended as each image lands so an interrupted run resumes
+            # where it stopped.
+            journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            manifest[str(seg)] = entry
+    if journal is not None:
+        journal.close()
+        write_manifest(manifest_path, manifest)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"Rendered {rendered} thumbnails in {elapsed:.1f}s: "
+          f"{rendered / elapsed:.1f} files/s, "
+          f"{total_bytes / elapsed / (1 << 20):.1f} MB/s, "
+          f"{len(failures)} failed")
+    if args.incremental:
+        print(f"Skipped {len(list_segs) - len(todo)} up to date, "
+              f"removed {len(stale)} stale thumbnails")
+    for seg, error in failures:
+        print(f"  {seg}: {error}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("in_seg", type=str, help="Directory containing nifti segmentation to visualise.")
+    parser.add_argument("--lean", action="store_true", help="Render with the lean PIL writer instead of matplotlib figures; faster and lighter on memory, but its images differ from the matplotlib layout.")
+    parser.add_argument("--incremental", action="store_true", help="Only render new or changed segmentations and remove stale thumbnails.")
+    parser.add_argument("--hash", action="store_true", help="In incremental mode, compare content hashes of files whose mtime changed.")
+    parser.add_argument("--workers", type=int, default=available_cpus(), help="Number of worker processes, the CPUs available to this process by default.")
+    parser.add_argument("--worker-mem-mb", type=int, default=None, help="Address space limit per worker in MB; a file exceeding it fails alone instead of exhausting memory.")
+    parser.add_argument("--output-dir", type=str, default=None, help="Output directory, images/ next to in_seg by default.")
+    parser.add_argument("--format", choices=sorted(EXTENSIONS), default="jpeg", help="Image format; webp is smallest for the same quality.")
+    parser.add_argument("--quality", type=int, default=75, help="JPEG/WebP quality, 1-100.")
+    parser.add_argument("--size", type=str, default="4200x1200", help="Full image size in pixels, WIDTHxHEIGHT.")
+    parser.add_argument("--preview-width", type=int, default=1050, help="Width of the low resolution previews the viewer shows first, 0 to skip them.")
+    parser.add_argument("--coarse-step", type=int, default=None, help="Find the crop of very large volumes with a strided scan of this step first, reading only the cropped region in full.")
     in_args = parser.parse_args()
     main(in_args)